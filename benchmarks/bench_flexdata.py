@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+
+"""
+Benchmarks for the flexdata parser and expansion engine. No root access or chroots are needed -- everything is run
+against a scratch config and mirror in a temporary directory.
+
+Two kinds of cases are run:
+
+real/<build>/<arch_desc>/<subarch>/<target> - the etc/ and targets/gentoo trees in this repository, loaded the same
+  way MetroSetup.get_settings() does it.
+synthetic/<name> - generated trees that stress one part of the engine: deeply nested $[[...]] and $[...] references,
+  thousands of conditional sections, and lots of small collected files.
+
+Each case is timed in phases: "base" (parsing ~/.metro and everything it collects, for real trees), "collect"
+(run_collector()), "expand" (expanding every variable, like expand_all(), but counting failures rather than stopping
+at the first one), "keys" (keys()), and "steps" (rendering every multi-line steps/ element, like run_script() does.)
+Results are written as JSON, so that runs can be compared over time.
+
+Usage: bench_flexdata.py [--repeat N] [--output file] [--parse-cache] [--quick] [pattern ...]
+
+If patterns are given, only cases whose names match one of them (fnmatch-style) are run.
+"""
+
+import fnmatch
+import getopt
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(root, "modules"))
+
+import flexdata
+
+builds = ("next", "1.4-release-std")
+arches = (
+	("x86-64bit", "generic_64"),
+	("x86-64bit", "intel64-haswell"),
+	("x86-32bit", "generic_32"),
+	("arm-64bit", "arm64_generic")
+)
+targets = ("snapshot", "stage1", "stage3", "gnome")
+version = "2000-01-01"
+
+config = """
+[section path]
+
+install: %(root)s
+tmp: %(tmp)s/tmp
+cache: $[path/tmp]/cache
+distfiles: %(tmp)s/distfiles
+work: $[path/tmp]/work/$[target/build]/$[target/name]
+
+[section path/mirror]
+
+: %(tmp)s/mirror
+owner: root
+group: root
+dirmode: 775
+
+[section portage]
+
+MAKEOPTS: -j5
+
+[section emerge]
+
+options: --jobs=1 --load-average=4 --keep-going=n
+
+[collect $[path/install]/etc/master.conf]
+"""
+
+
+def write_file(path, text):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, "w") as outf:
+		outf.write(text)
+
+
+def setup_real(tmp):
+	"""Write a scratch config, and the .control files that the real trees read with "<<", to tmp."""
+	write_file(os.path.join(tmp, "metro.conf"), config % {"root": root, "tmp": tmp})
+	for build in builds:
+		for arch_desc, subarch in arches:
+			control = os.path.join(tmp, "mirror", build, arch_desc, subarch, ".control")
+			write_file(os.path.join(control, "strategy/seed"), "stage3\n")
+			write_file(os.path.join(control, "strategy/build"), "local\n")
+			write_file(os.path.join(control, "version/stage3"), version + "\n")
+	return os.path.join(tmp, "metro.conf")
+
+
+def synthetic_deep(path, depth):
+	"""A chain of depth multi-line steps, each including the next with $[[...]], and a chain of depth $[...]s."""
+	lines = ["[section chain]", "", "0: end"]
+	for i in range(1, depth):
+		lines.append("%s: $[chain/%s]/%s" % (i, i - 1, i))
+	lines += ["", "[section steps]", ""]
+	for i in range(depth):
+		lines += ["level%s: [" % i, "echo level %s: $[chain/%s]" % (i, i), "echo $[chain/%s:zap] $[chain/missing:zap]" % (depth - 1)]
+		if i < depth - 1:
+			lines.append("$[[steps/level%s]]" % (i + 1))
+		lines += ["]", ""]
+	write_file(path, "\n".join(lines) + "\n")
+
+
+def synthetic_conditionals(path, count, choices=20):
+	"""count conditional sections, selected by one of choices values of bench/choice, plus steps that use them."""
+	lines = ["[section bench]", "", "choice: c%s" % (choices // 2), ""]
+	for i in range(count):
+		lines += ["[section cond/%s when bench/choice is c%s]" % (i // choices, i % choices), "", "value: %s" % i, ""]
+	lines += ["[section steps]", "", "conditionals: ["]
+	lines += ["echo $[cond/%s/value]" % i for i in range(count // choices)]
+	lines += ["]"]
+	write_file(path, "\n".join(lines) + "\n")
+
+
+def synthetic_wide(path, files, count):
+	"""files small files, each with count variables, each collected by the one before it once it has been parsed."""
+	for i in range(files):
+		lines = ["[section wide/%s]" % i, ""]
+		lines += ["v%s: $[wide/%s/v%s] %s" % (j, i - 1, j, j) if i else "v%s: %s" % (j, j) for j in range(count)]
+		if i < files - 1:
+			lines += ["", "[collect ./wide-%s.conf when wide/%s/v0]" % (i + 1, i)]
+		write_file(os.path.join(os.path.dirname(path), "wide-%s.conf" % i), "\n".join(lines) + "\n")
+	write_file(path, "[collect ./wide-0.conf]\n")
+
+
+def get_cases(tmp, quick):
+	"""Return a list of (name, conffile, args, target) tuples. target is None for synthetic cases."""
+	cases = []
+	conffile = setup_real(tmp)
+	for build in builds[:1] if quick else builds:
+		for arch_desc, subarch in arches[:1] if quick else arches:
+			args = {
+				"target/build": build,
+				"target/arch_desc": arch_desc,
+				"target/subarch": subarch,
+				"target/version": version,
+				"multi/mode": "full",
+				"multi": "yes"
+			}
+			for target in targets:
+				cases.append(("real/%s/%s/%s/%s" % (build, arch_desc, subarch, target), conffile, args, target))
+	synthetic = os.path.join(tmp, "synthetic")
+	scale = 1 if quick else 4
+	synthetic_deep(os.path.join(synthetic, "deep.conf"), 25 * scale)
+	cases.append(("synthetic/deep", os.path.join(synthetic, "deep.conf"), {}, None))
+	synthetic_conditionals(os.path.join(synthetic, "conditionals.conf"), 1000 * scale)
+	cases.append(("synthetic/conditionals", os.path.join(synthetic, "conditionals.conf"), {}, None))
+	synthetic_wide(os.path.join(synthetic, "wide.conf"), 50 * scale, 50)
+	cases.append(("synthetic/wide", os.path.join(synthetic, "wide.conf"), {}, None))
+	return cases
+
+
+def run_case(conffile, args, target, parse_cache):
+	"""Load and fully expand one case, returning the time taken by each phase, and some counts."""
+	times = {}
+	start = time.perf_counter()
+	settings = flexdata.Collection(parse_cache=parse_cache)
+	settings.collect(conffile, None)
+	for key, value in args.items():
+		settings[key] = value
+	if target is not None:
+		settings.run_collector(defer=["target"])
+		settings = settings.overlay()
+		settings["target"] = target
+		times["base"] = time.perf_counter() - start
+		start = time.perf_counter()
+	settings.run_collector()
+	times["collect"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	errors = 0
+	for key in list(settings.keys()):
+		try:
+			settings[key]
+		except (flexdata.FlexDataError, KeyError, IOError):
+			errors += 1
+	times["expand"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	keys = settings.keys()
+	times["keys"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	steps = lines = 0
+	for key in keys:
+		if key.startswith("steps/") and settings.is_multi(key):
+			steps += 1
+			try:
+				for line in settings.iter_multi(key):
+					lines += 1
+			except (flexdata.FlexDataError, KeyError, IOError):
+				errors += 1
+	times["steps"] = time.perf_counter() - start
+
+	times["total"] = sum(times.values())
+	counts = {
+		"files": len(settings.collected),
+		"keys": len(keys),
+		"errors": errors,
+		"steps": steps,
+		"step_lines": lines
+	}
+	return times, counts
+
+
+def git_revision():
+	try:
+		return subprocess.check_output(["git", "-C", root, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def usage():
+	print(__doc__.strip())
+
+
+def main():
+	try:
+		opts, patterns = getopt.getopt(sys.argv[1:], "hn:o:", ["help", "repeat=", "output=", "parse-cache", "quick"])
+	except getopt.GetoptError as e:
+		print(e)
+		usage()
+		return 1
+	repeat = 3
+	output = None
+	use_parse_cache = False
+	quick = False
+	for opt, value in opts:
+		if opt in ("-h", "--help"):
+			usage()
+			return 0
+		elif opt in ("-n", "--repeat"):
+			repeat = max(int(value), 1)
+		elif opt in ("-o", "--output"):
+			output = value
+		elif opt == "--parse-cache":
+			use_parse_cache = True
+		elif opt == "--quick":
+			quick = True
+
+	# recursive expansion of the deep synthetic tree goes well past the default limit:
+	sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+	tmp = tempfile.mkdtemp(prefix="metro-bench-")
+	try:
+		results = []
+		for name, conffile, args, target in get_cases(tmp, quick):
+			if patterns and not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+				continue
+			# the parse cache is shared by every run of a case, so all but the first run start out with it warm:
+			parse_cache = flexdata.ParseCache(os.path.join(tmp, "parse-cache", name)) if use_parse_cache else None
+			runs = []
+			counts = None
+			for i in range(repeat):
+				times, counts = run_case(conffile, args, target, parse_cache)
+				runs.append(times)
+			summary = {}
+			for phase in runs[0]:
+				samples = [times[phase] for times in runs]
+				summary[phase] = {"min": min(samples), "median": statistics.median(samples), "max": max(samples)}
+			results.append({"name": name, "counts": counts, "times": summary})
+			sys.stderr.write("%-60s %8.3fs (median of %s)\n" % (name, summary["total"]["median"], repeat))
+	finally:
+		shutil.rmtree(tmp)
+
+	report = {
+		"time": time.time(),
+		"revision": git_revision(),
+		"python": platform.python_version(),
+		"host": platform.node(),
+		"repeat": repeat,
+		"parse_cache": use_parse_cache,
+		"results": results
+	}
+	if output is None:
+		json.dump(report, sys.stdout, indent=4)
+		sys.stdout.write("\n")
+	else:
+		with open(output, "w") as outf:
+			json.dump(report, outf, indent=4)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
+
+# vim: ts=4 sw=4 noet
@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+
+"""
+Regression checks for the caching and locking code in modules/, which is hard to exercise through a real build. No
+root access or chroots are needed -- everything is run in a temporary directory.
+
+cycles - a circular reference is found whatever order variables are expanded in, even if part of the cycle has
+  already been expanded, and memoized, on its own.
+embedded - what an embedded python block writes to sys.stdout is captured as its output, and what other threads
+  write at the same time isn't.
+lockfile - LockFile only reclaims a lock file that isn't flock()ed if it was created on this host, by a process that
+  no longer exists.
+logsink - a LogSink whose log can't be finished off (its compressor fails) still closes, rather than hanging.
+profiles - Profiles can profile targets run in worker threads while the thread waiting for them is itself being
+  profiled, whichever version of Python we're run with.
+settings - the real target trees (the same cases as bench_flexdata.py) expand to the same values, and fail with the
+  same errors, however they're loaded: in one go with nothing memoized, like metro used to, or as an overlay of the
+  base settings with memoization, with a cold and a warm parse cache, and after a round trip through a settings bundle.
+
+Usage: regressions.py [check ...]
+
+If no checks are named, all of them are run. The exit status is non-zero if any of them fail.
+"""
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(root, "modules"))
+
+import bench_flexdata
+import flexdata
+import metro_support
+
+
+class CheckFailed(Exception):
+	pass
+
+
+def expect(what, got, wanted):
+	if got != wanted:
+		raise CheckFailed("%s: got %r, expected %r" % (what, got, wanted))
+
+
+def dead_pid():
+	"""Return the pid of a process that has exited, and been reaped."""
+	proc = subprocess.Popen(["true"])
+	proc.wait()
+	return proc.pid
+
+
+def check_cycles(tmp):
+	path = os.path.join(tmp, "cycles.conf")
+	with open(path, "w") as outf:
+		outf.write("[section cycle]\n\na: $[cycle/d] x\nd: $[cycle/a?]y\n")
+	for order in (["cycle/a", "cycle/d"], ["cycle/d", "cycle/a"]):
+		settings = flexdata.Collection()
+		settings.collect(path, None)
+		for varname in order:
+			try:
+				settings[varname]
+			except KeyError as e:
+				if not str(e.args[0]).startswith("Circular reference"):
+					raise
+			else:
+				if varname == "cycle/a":
+					raise CheckFailed("%s: expanded %s, which is a circular reference" % (", ".join(order), varname))
+
+
+def check_embedded(tmp):
+	embedded = flexdata.EmbeddedPython()
+	source = "import sys, time\nsys.stdout.write('written\\n')\ntime.sleep(0.2)\nprint('printed')\n"
+	stop = threading.Event()
+
+	def chatter():
+		while not stop.is_set():
+			sys.stdout.write("chatter\n")
+			time.sleep(0.01)
+
+	other = io.StringIO()
+	with contextlib.redirect_stdout(other):
+		thread = threading.Thread(target=chatter)
+		thread.start()
+		try:
+			output = embedded.run(source, {})
+		finally:
+			stop.set()
+			thread.join()
+	expect("block output", output, "written\nprinted\n")
+	expect("other output", sorted(set(other.getvalue().split())), ["chatter"])
+
+
+class UnmemoizedCollection(flexdata.Collection):
+
+	def memo_set(self, memo_key, value, deps):
+		pass
+
+
+def load_flat(conffile, args, target):
+	settings = UnmemoizedCollection()
+	settings.collect(conffile, None)
+	for key, value in args.items():
+		settings[key] = value
+	settings["target"] = target
+	settings.run_collector()
+	return settings
+
+
+def load_overlay(conffile, args, target, parse_cache):
+	# the same way MetroSetup.get_settings() does it:
+	settings = flexdata.Collection(parse_cache=parse_cache)
+	settings.collect(conffile, None)
+	for key, value in args.items():
+		settings[key] = value
+	settings.run_collector(defer=["target"])
+	settings = settings.overlay()
+	settings["target"] = target
+	settings.run_collector()
+	return settings
+
+
+def dump(settings):
+	"""Return the values of every variable in settings (and its "?" form), or the errors expanding them raised."""
+	values = {}
+	for key in settings.keys():
+		for element in (key, key + "?"):
+			try:
+				values[element] = settings[element]
+			except Exception as e:
+				# as stored in a settings bundle:
+				values[element] = (type(e).__name__, [arg if type(arg) in [str, int] else str(arg) for arg in e.args])
+	return values
+
+
+def check_settings(tmp):
+	parse_cache = flexdata.ParseCache(os.path.join(tmp, "parse-cache"))
+	failed = []
+	for name, conffile, args, target in bench_flexdata.get_cases(tmp, False):
+		if target is None:
+			continue
+		# expanding variables that fail prints their errors:
+		with contextlib.redirect_stdout(io.StringIO()):
+			wanted = dump(load_flat(conffile, args, target))
+			loaded = [
+				("memoized", load_overlay(conffile, args, target, None)),
+				("cold parse cache", load_overlay(conffile, args, target, parse_cache)),
+				("warm parse cache", load_overlay(conffile, args, target, parse_cache))
+			]
+			bundle = json.loads(json.dumps(loaded[-1][1].freeze().to_dict()))
+			loaded.append(("bundle", flexdata.FrozenCollection.from_dict(bundle)))
+			for how, settings in loaded:
+				got = dump(settings)
+				if got != wanted:
+					differ = sorted(key for key in set(got) | set(wanted) if got.get(key) != wanted.get(key))
+					failed.append("%s (%s): %s" % (name, how, " ".join(differ[:5])))
+	if failed:
+		raise CheckFailed("settings differ: " + "; ".join(failed))
+
+
+def check_lockfile(tmp):
+	path = os.path.join(tmp, "lock")
+	this_host = metro_support.host_name()
+
+	def write_lock(hostname, pid):
+		with open(path, "w") as outf:
+			outf.write("%s:%s" % (hostname, pid))
+
+	# lock files that aren't flock()ed, as written by other hosts over NFS, or by older versions of metro:
+	for what, hostname, pid, held in (
+		("other host, dead pid", "some-other-host", dead_pid(), True),
+		("other host, live pid", "some-other-host", os.getpid(), True),
+		("this host, live pid", this_host, os.getpid(), True),
+		("this host, dead pid", this_host, dead_pid(), False)
+	):
+		write_lock(hostname, pid)
+		lock = metro_support.LockFile(path)
+		expect(what + ": info()", lock.info()["held"], held)
+		expect(what + ": exists()", lock.exists(), held)
+		expect(what + ": lock file kept", os.path.exists(path), held)
+		if os.path.exists(path):
+			os.unlink(path)
+
+	with open(path, "w") as outf:
+		outf.write("garbage")
+	expect("unparseable lock file: exists()", metro_support.LockFile(path).exists(), True)
+	os.unlink(path)
+
+	# a lock file that is flock()ed by a live process is held, whatever it says:
+	lock = metro_support.LockFile(path)
+	expect("create()", lock.create(), True)
+	other = metro_support.LockFile(path)
+	expect("flock()ed: exists()", other.exists(), True)
+	expect("flock()ed: create()", other.create(), False)
+	lock.unlink()
+	expect("unlink()", os.path.exists(path), False)
+
+
+class FailingLogSink(metro_support.PipeLogSink):
+
+	command = ["sh", "-c", "cat >/dev/null; exit 1"]
+
+
+def check_logsink(tmp):
+	for data in (b"", b"some output\n"):
+		sink = FailingLogSink(os.path.join(tmp, "stage3.txt"), flush_interval=0.1)
+		sink.write(data)
+		closer = threading.Thread(target=sink.close, daemon=True)
+		with contextlib.redirect_stderr(io.StringIO()):
+			closer.start()
+			closer.join(10)
+		expect("close() returned", closer.is_alive(), False)
+		expect("error", type(sink.error), IOError)
+
+
+def check_profiles(tmp):
+	profiles = metro_support.Profiles()
+	results = []
+	# make the targets overlap, so that on Python 3.12 and later, only one of them can be profiled:
+	barrier = threading.Barrier(2)
+
+	def target():
+		barrier.wait()
+		results.append(sum(range(100000)))
+
+	def run_targets():
+		with profiles.paused():
+			threads = [threading.Thread(target=profiles.profiled, args=(target,)) for i in range(2)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+		return sum(range(1000))
+
+	expect("result", profiles.profiled(run_targets), sum(range(1000)))
+	expect("targets run", len(results), 2)
+	expect("profiled and unprofiled", len(profiles.profiles) + profiles.unprofiled, 3)
+	expect("targets profiled", len(profiles.profiles) > 1, True)
+
+
+checks = [
+	("cycles", check_cycles),
+	("embedded", check_embedded),
+	("lockfile", check_lockfile),
+	("logsink", check_logsink),
+	("profiles", check_profiles),
+	("settings", check_settings)
+]
+
+
+def main():
+	names = sys.argv[1:]
+	unknown = set(names) - set(name for name, check in checks)
+	if unknown:
+		print("Unknown checks: %s" % " ".join(sorted(unknown)))
+		print(__doc__.strip())
+		return 1
+	failed = 0
+	for name, check in checks:
+		if names and name not in names:
+			continue
+		tmp = tempfile.mkdtemp(prefix="metro-check-")
+		try:
+			check(tmp)
+			sys.stderr.write("%-20s ok\n" % name)
+		except CheckFailed as e:
+			sys.stderr.write("%-20s FAILED: %s\n" % (name, e))
+			failed += 1
+		finally:
+			shutil.rmtree(tmp)
+	return 1 if failed else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
+
+# vim: ts=4 sw=4 noet
@@ -1,8 +1,13 @@
 #!/usr/bin/python
 
+import builtins
+import hashlib
 import io
+import json
 import os
 import sys
+import threading
+from collections import deque
 
 
 class FlexDataError(Exception):
@@ -13,6 +18,133 @@ class FlexDataError(Exception):
 			print()
 
 
+class ParseCache:
+
+	"""ParseCache stores the parse operations generated by Collection.compile_file() on disk, in a directory of
+	small JSON files, one per parsed file. An entry is used if the mtime and size of the file are unchanged, or
+	failing that, if the sha256 hash of the file's contents matches. Any problem reading or writing the cache
+	simply results in the file being parsed again. Entries are also kept in memory, for long-running processes
+	such as the metro daemon."""
+
+	version = 1
+
+	def __init__(self, path):
+		self.path = path
+		self.memory = {}
+
+	def entry_path(self, filename):
+		return os.path.join(self.path, hashlib.sha1(filename.encode("utf-8")).hexdigest() + ".json")
+
+	def read_entry(self, filename):
+		try:
+			with open(self.entry_path(filename), "r") as entfile:
+				entry = json.loads(entfile.read())
+		except (IOError, ValueError):
+			return None
+		if type(entry) != dict or entry.get("version") != self.version or entry.get("path") != filename:
+			return None
+		return entry
+
+	def write_entry(self, filename, entry):
+		entry_path = self.entry_path(filename)
+		tmp_path = "%s.%s.%s.tmp" % (entry_path, os.getpid(), threading.get_ident())
+		try:
+			os.makedirs(self.path, exist_ok=True)
+			with open(tmp_path, "w") as entfile:
+				entfile.write(json.dumps(entry, separators=(",", ":")))
+			os.replace(tmp_path, entry_path)
+		except (IOError, OSError):
+			try:
+				os.unlink(tmp_path)
+			except OSError:
+				pass
+
+	def get(self, filename, compiler):
+		"""Return the parse operations for filename, calling compiler(filename, text) to generate them if our
+		cached copy is missing or out of date."""
+		try:
+			st = os.stat(filename)
+		except OSError:
+			return None
+		entry = self.memory.get(filename)
+		if entry is None:
+			entry = self.read_entry(filename)
+		if entry is not None and entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+			self.memory[filename] = entry
+			return entry["ops"]
+		with open(filename, "rb") as infile:
+			data = infile.read()
+		digest = hashlib.sha256(data).hexdigest()
+		if entry is None or entry["hash"] != digest:
+			entry = {"version": self.version, "path": filename, "hash": digest, "ops": compiler(filename, data.decode("utf-8"))}
+		entry["mtime"] = st.st_mtime_ns
+		entry["size"] = st.st_size
+		self.write_entry(filename, entry)
+		self.memory[filename] = entry
+		return entry["ops"]
+
+
+class BlockStdout:
+
+	"""BlockStdout stands in for sys.stdout. While a thread is running an embedded python block, what it writes goes
+	to the block's output buffer; everything else is passed through to the real stdout."""
+
+	def __init__(self, stdout):
+		self.stdout = stdout
+		self.local = threading.local()
+
+	def target(self):
+		buf = getattr(self.local, "buf", None)
+		return self.stdout if buf is None else buf
+
+	def write(self, data):
+		return self.target().write(data)
+
+	def __getattr__(self, name):
+		# flush(), fileno(), encoding and so on:
+		return getattr(self.target(), name)
+
+
+class EmbeddedPython:
+
+	"""EmbeddedPython runs the <?python ... ?> blocks found in multi-line elements. Each block is compiled once, but
+	run every time, since a block can look at files, the environment and so on. A block gets its own print() function,
+	which writes to a private buffer, and sys.stdout is replaced (once) by a BlockStdout, so that writing to sys.stdout
+	from a block ends up in the same buffer. Output from other threads is left alone, so blocks can be run from more
+	than one thread at a time."""
+
+	lock = threading.Lock()
+
+	def __init__(self):
+		self.code = {}
+
+	@classmethod
+	def capture_stdout(cls):
+		with cls.lock:
+			if not isinstance(sys.stdout, BlockStdout):
+				sys.stdout = BlockStdout(sys.stdout)
+			return sys.stdout
+
+	def run(self, source, mylocals):
+		"""Run source with mylocals as its local variables, and return what it printed."""
+		if source not in self.code:
+			self.code[source] = compile(source, "<?python", "exec")
+		outbuf = io.StringIO()
+
+		def block_print(*args, **kwargs):
+			if kwargs.get("file") is None:
+				kwargs["file"] = outbuf
+			print(*args, **kwargs)
+
+		stdout = self.capture_stdout()
+		stdout.local.buf = outbuf
+		try:
+			exec(self.code[source], {"os": os, "print": block_print}, mylocals)
+		finally:
+			stdout.local.buf = None
+		return outbuf.getvalue()
+
+
 class Collection:
 	""" The collection class holds our parser.
 
@@ -27,9 +159,11 @@ class Collection:
 
 	"""
 
-	def __init__(self, debug=False):
+	def __init__(self, debug=False, parse_cache=None):
 		self.clear()
 		self.debug = debug
+		# parse_cache, if set, is a ParseCache object used to avoid re-parsing files we have seen before:
+		self.parse_cache = parse_cache
 		self.pre = "$["
 		self.suf = "]"
 		self.immutable = False
@@ -39,11 +173,12 @@ class Collection:
 		self.blanks = {}
 		# self.collected holds the names of files we've collected (parsed)
 		self.collected = []
-		self.section = ""
+		# self.read_files holds the names of files we've read values from, using "<<"
+		self.read_files = {}
 		self.section_for = {}
-		self.conditional = None
 		self.collector = []
 		self.collector_cond = {}
+		self.collector_waiting = {}
 		self.raw = {}
 		self.conditionals = {}
 		self.defined_in_file = {}
@@ -53,6 +188,50 @@ class Collection:
 		self.conditionals = {}
 		self.blanks = {}
 		self.defined_in_file = {}
+		# self.memo holds expanded values of single-line variables, keyed by (varname, lax option, caller is lax), along
+		# with the set of variable names each value depended on. self.memo_deps maps a variable name to the memo keys
+		# that depend on it, so that redefining a variable only invalidates the values that used it. self.dep_stack
+		# holds the dependency sets of the expansions currently in progress.
+		self.memo = {}
+		self.memo_deps = {}
+		self.dep_stack = []
+		self.predicates = {}
+		self.templates = {}
+		self.embedded = EmbeddedPython()
+
+	def depends_on(self, varname):
+		# record that the expansion in progress looked at varname. A varname of None means that the expansion read
+		# something outside of our data (such as a file) and can't be memoized.
+		if self.dep_stack:
+			self.dep_stack[-1].add(varname)
+
+	def memo_get(self, memo_key, stack=()):
+		# return True and the memoized value for memo_key, or False and None if we don't have one. A value that depended
+		# on a variable in stack isn't used, since expanding it again would find a circular reference.
+		if memo_key not in self.memo:
+			return False, None
+		value, deps = self.memo[memo_key]
+		if stack and not deps.isdisjoint(stack):
+			return False, None
+		if self.dep_stack:
+			self.dep_stack[-1].update(deps)
+		return True, value
+
+	def memo_set(self, memo_key, value, deps):
+		# memoize value under memo_key, unless it depended on something we can't track (see depends_on()):
+		if None in deps:
+			return
+		self.memo[memo_key] = (value, deps)
+		for dep in deps:
+			if dep not in self.memo_deps:
+				self.memo_deps[dep] = set()
+			self.memo_deps[dep].add(memo_key)
+
+	def invalidate(self, varname):
+		# varname has been (re)defined or deleted, so forget any expanded values that depended on it.
+		for memo_key in self.memo_deps.pop(varname, ()):
+			if memo_key in self.memo:
+				del self.memo[memo_key]
 
 	def expand_all(self):
 		# try to expand all variables to find any undefined elements, to record all blanks or throw an exception
@@ -60,21 +239,35 @@ class Collection:
 			assert self[key]
 
 	def get_condition_for(self, varname):
+		# Return the value of varname from the conditional block whose condition is true, or None. The winner is
+		# memoized (under a ("when", varname) key) until varname or one of the variables its conditions test changes.
+		self.depends_on(varname)
 		if varname not in self.conditionals:
 			return None
-		true_keys = []
-		for cond in list(self.conditionals[varname].keys()):
-			if self.condition_true(cond):
-				true_keys.append(cond)
-			if len(true_keys) > 1:
-				raise FlexDataError("Multiple true conditions exist for %s: conditions: %s" % (varname, repr(true_keys)))
+		memo_key = ("when", varname)
+		found, value = self.memo_get(memo_key)
+		if found:
+			return value
+		deps = {varname}
+		self.dep_stack.append(deps)
+		try:
+			true_keys = []
+			for cond in self.conditionals[varname]:
+				if self.condition_true(cond):
+					true_keys.append(cond)
+				if len(true_keys) > 1:
+					raise FlexDataError("Multiple true conditions exist for %s: conditions: %s" % (varname, repr(true_keys)))
+		finally:
+			# whether or not we succeeded, whatever we looked at is a dependency of the expansion that asked us:
+			self.dep_stack.pop()
+			if self.dep_stack:
+				self.dep_stack[-1].update(deps)
 		if len(true_keys) == 1:
-			return self.conditionals[varname][true_keys[0]]
-		elif len(true_keys) == 0:
-			return None
+			value = self.conditionals[varname][true_keys[0]]
 		else:
-			# shouldn't get here
-			raise FlexDataError
+			value = None
+		self.memo_set(memo_key, value, deps)
+		return value
 
 	def expand(self, myvar, options=None):
 		if options is None:
@@ -84,11 +277,12 @@ class Collection:
 			myvar = myvar[:-1]
 		else:
 			boolean = False
+		self.depends_on(myvar)
 		if myvar in self.raw:
 			typetest = self.raw[myvar]
 		elif myvar in self.conditionals:
 			# test the type of the first conditional - in the future, we should ensure all conditional values are of the same type
-			typetest = self.conditionals[myvar][list(self.conditionals[myvar].keys())[0]]
+			typetest = next(iter(self.conditionals[myvar].values()))
 		# FIXME: COME BACK HERE AND FIX THIS
 		elif myvar in self.lax_vars and self.lax_vars[myvar]:
 			# record that we looked up an undefined element
@@ -110,6 +304,87 @@ class Collection:
 		else:
 			return self.expand_string(myvar=myvar, options=options)
 
+	def compile_template(self, mystring):
+		"""
+		Compile a single-line value into a template that expand_string() can walk without re-scanning the string. We
+		return a tuple (fromfile, tokens), where fromfile is True for "<< filename" values, and tokens is a list of
+		literal strings and (varname, boolean, relative, mode) tuples for $[...] references. relative is None, or for
+		$[], $[:] and $[:foo] references, the string to append to the section name ("" or "/foo"). mode is None, "zap"
+		or "lax". Templates are cached by string in self.templates.
+		"""
+		if mystring in self.templates:
+			return self.templates[mystring]
+		mysplit = mystring.strip().split(" ")
+		if len(mysplit) == 2 and mysplit[0] == "<<":
+			fromfile = True
+			unex = mysplit[1]
+		else:
+			fromfile = False
+			unex = mystring
+		tokens = []
+		literal = ""
+		while unex != "":
+			varpos = unex.find(self.pre)
+			if varpos == -1:
+				literal += unex
+				break
+			if unex[varpos:varpos + len(self.pre) + 1] == "$[[":
+				# extra "[", so it's a multi-line element .... which we just pass to the output unexpanded since it might be commented out...
+				# (we don't want to throw an exception if someone put a # in front of it.)
+				literal += unex[0:varpos + len(self.pre) + 1]
+				unex = unex[varpos + len(self.pre) + 1:]
+				continue
+			# OK, this looks like a regular single-line element
+			literal += unex[0:varpos]
+			if literal:
+				tokens.append(literal)
+				literal = ""
+			unex = unex[varpos + len(self.pre):]  # remove "$["
+			endvarpos = unex.find(self.suf)
+			if endvarpos == -1:
+				raise FlexDataError("Error expanding variable for '" + mystring + "'")
+			varname = unex[0:endvarpos]
+			unex = unex[endvarpos + len(self.suf):]
+			if len(varname) > 0 and varname[-1] == "?":
+				boolean = True
+				varname = varname[:-1]
+			else:
+				boolean = False
+			relative = None
+			if varname == "" or varname == ":":
+				relative = ""
+				varname = ""
+			elif varname[0] == ":":
+				# something like $[:foo/bar]
+				relative = "/" + varname[1:]
+				varname = ""
+			varsplit = (relative if relative is not None else varname).split(":")
+			mode = None
+			if len(varsplit) == 1:
+				pass
+			elif len(varsplit) == 2:
+				if varsplit[1] not in ["zap", "lax"]:
+					raise FlexDataError("expanding variable %s - mode %s does not exist" % (varsplit[0], varsplit[1]))
+				mode = varsplit[1]
+				if relative is not None:
+					relative = varsplit[0]
+				else:
+					varname = varsplit[0]
+			else:
+				raise FlexDataError('expanding variable %s - invalid variable' % varname)
+			tokens.append((varname, boolean, relative, mode))
+		if literal:
+			tokens.append(literal)
+		self.templates[mystring] = (fromfile, tokens)
+		return fromfile, tokens
+
+	def is_multi(self, myvar):
+		# return True if myvar is a multi-line element, without expanding it.
+		if myvar in self.raw:
+			return type(self.raw[myvar]) == list
+		multi = self.get_condition_for(myvar)
+		return type(multi) == list
+
 	def expand_string(self, mystring=None, myvar=None, stack=None, options=None):
 		# Expand all variables in a basic value, ie. a string
 		if stack is None:
@@ -122,6 +397,7 @@ class Collection:
 				myvar = myvar[:-1]
 			else:
 				boolean = False
+			self.depends_on(myvar)
 			if myvar in self.raw:
 				if boolean:
 					if self.raw[myvar].strip() == "":
@@ -130,7 +406,7 @@ class Collection:
 					else:
 						mystring = "yes"
 				else:
-					mystring = self.raw[myvar]
+					return self.expand_var(myvar, stack, options)
 			else:
 				mystring = self.get_condition_for(myvar)
 				if mystring is None:
@@ -142,135 +418,128 @@ class Collection:
 						raise KeyError("Variable " + repr(myvar) + " not found.")
 				elif boolean:
 					mystring = "yes"
+				else:
+					return self.expand_var(myvar, stack, options)
 
-		if type(mystring) != list:
-			mysplit = mystring.strip().split(" ")
-		else:
+		if type(mystring) == list:
 			# concatenate multi-line element, then strip
 			mysplit = []
 			for line in mystring:
 				mysplit.append(line.strip())
 			mystring = " ".join(mysplit).strip()
-			mysplit = mystring.split(" ")
-
-		if len(mysplit) == 2 and mysplit[0] == "<<":
-			fromfile = True
-			mystring = " ".join(mysplit[1:])
-		else:
-			fromfile = False
+		fromfile, tokens = self.compile_template(mystring)
 
-		unex = mystring
-		ex = ""
-		while unex != "":
-			varpos = unex.find(self.pre)
-			if varpos == -1:
-				ex += unex
-				unex = ""
-				continue
-			if unex[varpos:varpos + len(self.pre) + 1] == "$[[":
-				# extra "[", so it's a multi-line element .... which we just pass to the output unexpanded since it might be commented out...
-				# (we don't want to throw an exception if someone put a # in front of it.)
-				ex += unex[0:varpos + len(self.pre) + 1]
-				unex = unex[varpos + len(self.pre) + 1:]
+		ex = []
+		for token in tokens:
+			if type(token) == str:
+				ex.append(token)
 				continue
-			# OK, this looks like a regular single-line element
-			ex += unex[0:varpos]
-			unex = unex[varpos + len(self.pre):]  # remove "$["
-			endvarpos = unex.find(self.suf)
-			if endvarpos == -1:
-				raise FlexDataError("Error expanding variable for '" + mystring + "'")
-			varname = unex[0:endvarpos]
-			if len(varname) > 0 and varname[-1] == "?":
-				boolean = True
-				varname = varname[:-1]
-			else:
-				boolean = False
-			# $[] and $[:] expansion
-			if varname == "" or varname == ":":
+			varname, boolean, relative, mode = token
+			# $[], $[:] and $[:foo/bar] expansion
+			if relative is not None:
 				if myvar in self.section_for:
-					varname = self.section_for[myvar]
-				else:
-					raise FlexDataError("no section name for " + myvar + " in " + mystring)
-			# NEW STUFF BELOW:
-			elif varname[0] == ":":
-				# something like $[:foo/bar]
-				if myvar in self.section_for:
-					varname = self.section_for[myvar] + "/" + varname[1:]
-				else:
-					raise FlexDataError("no section name for " + myvar + " in " + mystring)
-			varsplit = varname.split(":")
-			newoptions = options.copy()
-			zapmode = False
-			if len(varsplit) == 1:
-				pass
-			elif len(varsplit) == 2:
-				if varsplit[1] == "zap":
-					zapmode = True
-					varname = varsplit[0]
-				elif varsplit[1] == "lax":
-					newoptions["lax"] = True
-					varname = varsplit[0]
+					varname = self.section_for[myvar] + relative
 				else:
-					raise FlexDataError("expanding variable %s - mode %s does not exist" % (varname, varsplit[1]))
+					raise FlexDataError("no section name for %s in %s" % (myvar, mystring))
+			if mode == "lax":
+				newoptions = options.copy()
+				newoptions["lax"] = True
 			else:
-				raise FlexDataError('expanding variable %s - invalid variable' % varname)
-			unex = unex[endvarpos + len(self.suf):]
+				newoptions = options
+			zapmode = mode == "zap"
+			self.depends_on(varname)
 			if varname in stack:
 				raise KeyError("Circular reference of '" + varname + "' by " + repr(myvar) + " ( Call stack: " + repr(stack) + ' )')
 			if varname in self.raw:
 				new_stack = stack[:]
 				new_stack.append(myvar)
 				if not boolean:
-					newex = self.expand_string(self.raw[varname], varname, new_stack, options=newoptions)
+					newex = self.expand_var(varname, new_stack, newoptions)
 					if newex == "" and zapmode is True:
 						# when expand_multi gets None, it won't add this line, so we won't get a blank line even
 						return None
 					else:
 						if newex is not None:
-							ex += newex
+							ex.append(newex)
 						else:
 							return None
 				else:
 					# self.raw[varname] can be a list. if it's a string and blank, we treat it as undefined.
 					if type(self.raw[varname]) == bytes and self.raw[varname].strip() == "":
-						ex += "no"
+						ex.append("no")
 					else:
-						ex += "yes"
+						ex.append("yes")
 			elif varname in self.conditionals:
-				expand_me = self.get_condition_for(varname)
 				new_stack = stack[:]
 				new_stack.append(myvar)
-				if expand_me is None:
-					raise KeyError("Variable %s not found (stack: %s )" % (varname, repr(new_stack)))
 				if not boolean:
-					ex += self.expand_string(expand_me, varname, new_stack, options=newoptions)
+					newex = self.expand_var(varname, new_stack, newoptions)
+					if newex is None:
+						return None
+					ex.append(newex)
+				elif self.get_condition_for(varname) is None:
+					raise KeyError("Variable %s not found (stack: %s )" % (varname, repr(new_stack)))
 				else:
-					ex += "yes"
+					ex.append("yes")
 			else:
 				if zapmode:
 					# a ":zap" will cause the line to be deleted if there is no variable defined or the var evals to an empty string
 					# when expandMulti gets None, it won't add this line so we won't get a blank line even
 					return None
-				if ("lax" in list(newoptions.keys())) or (len(stack) and stack[-1] in self.lax_vars and self.lax_vars[stack[-1]]):
+				if ("lax" in newoptions) or (len(stack) and stack[-1] in self.lax_vars and self.lax_vars[stack[-1]]):
 					# record variables that we attempted to expand but were blank, so we can inform the user of possible bugs
 					if boolean:
-						ex += "no"
+						ex.append("no")
 					else:
 						self.blanks[varname] = True
-						ex += ""
 				else:
 					if not boolean:
 						raise KeyError("Cannot find variable %s (in %s)" % (varname, myvar))
 					else:
-						ex += "no"
+						ex.append("no")
+		ex = "".join(ex)
 		if fromfile is False:
 			return ex
 
-		# use "ex" as a filename
+		# use "ex" as a filename. The file can change underneath us, so don't memoize anything that depends on it:
+		self.depends_on(None)
+		self.read_files[ex] = True
 		with open(ex, "r") as myfile:
 			return myfile.read().strip()
 
+	def expand_var(self, myvar, stack, options):
+		# Expand the value of single-line variable myvar, as referenced by stack[-1]. Results are memoized - apart from
+		# myvar itself, the result only depends on the "lax" option and whether the referencing variable is lax.
+		if myvar in stack:
+			raise KeyError("Circular reference of '" + myvar + "' ( Call stack: " + repr(stack) + ' )')
+		memo_key = (myvar, "lax" in options, len(stack) > 0 and self.lax_vars.get(stack[-1], False))
+		found, value = self.memo_get(memo_key, stack)
+		if found:
+			return value
+		deps = {myvar}
+		self.dep_stack.append(deps)
+		try:
+			if myvar in self.raw:
+				mystring = self.raw[myvar]
+			else:
+				mystring = self.get_condition_for(myvar)
+				if mystring is None:
+					raise KeyError("Variable %s not found (stack: %s )" % (myvar, repr(stack)))
+			value = self.expand_string(mystring, myvar, stack, options=options)
+		finally:
+			# whether or not we succeeded, whatever we looked at is a dependency of the expansion that asked us:
+			self.dep_stack.pop()
+			if self.dep_stack:
+				self.dep_stack[-1].update(deps)
+		self.memo_set(memo_key, value, deps)
+		return value
+
 	def expand_multi(self, myvar, stack=None, options=None):
+		return list(self.iter_multi(myvar, stack, options))
+
+	def iter_multi(self, myvar, stack=None, options=None):
+		# Generator that yields the expanded lines of a multi-line value one at a time, so that large values can be
+		# written out without building the whole thing in memory. expand_multi() returns the same lines as a list.
 		if stack is None:
 			stack = []
 		if options is None:
@@ -290,6 +559,7 @@ class Collection:
 				raise FlexDataError("Invalid multi-line variable")
 
 		# Expand all variables in a multi-line value. stack is used internally to detect circular references.
+		self.depends_on(myvar)
 		if myvar in self.raw:
 			multi = self.raw[myvar]
 			if type(multi) != list:
@@ -299,10 +569,9 @@ class Collection:
 			if multi is None:
 				if ("lax" in list(newoptions.keys())) or (len(stack) and stack[-1] in self.lax_vars and self.lax_vars[stack[-1]]):
 					self.blanks[myvar] = True
-					return ""
+					return
 				else:
 					raise FlexDataError("referenced variable \"" + myvar + "\" not found")
-		newlines = []
 
 		pos = 0
 		while pos < len(multi):
@@ -314,33 +583,31 @@ class Collection:
 					raise FlexDataError("Circular reference of '" + myref + "' by '" + stack[-1] + "' ( Call stack: " + repr(stack) + ' )')
 				newstack = stack[:]
 				newstack.append(myvar)
-				newlines += self.expand_multi(self.expand_string(mystring=myref), newstack, options=newoptions)
+				yield from self.iter_multi(self.expand_string(mystring=myref), newstack, options=newoptions)
 			elif len(mysplit) >= 1 and mysplit[0] == "<?python":
-				sys.stdout = io.StringIO()
-				mycode = ""
+				self.depends_on(None)
+				mycode = []
 				pos += 1
 				while pos < len(multi):
 					newsplit = multi[pos].split()
 					if len(newsplit) >= 1 and newsplit[0] == "?>":
 						break
 					else:
-						mycode += multi[pos] + "\n"
+						mycode.append(multi[pos] + "\n")
 						pos += 1
-				exec(mycode, {"os": os}, mylocals)
-				newlines.append(sys.stdout.getvalue())
-				sys.stdout = sys.__stdout__
+				yield self.embedded.run("".join(mycode), mylocals)
 			else:
 				newline = self.expand_string(mystring=multi[pos], options=newoptions)
 				if newline is not None:
-					newlines.append(newline)
+					yield newline
 			pos += 1
-		return newlines
 
 	def __setitem__(self, key, value):
 		if self.immutable and key in self.raw:
 			raise IndexError("Attempting to redefine " + key + " to " + value + " when immutable.")
 		self.raw[key] = value
 		self.defined_in_file[key] = "via __setitem__"
+		self.invalidate(key)
 
 	def __delitem__(self, key):
 		if self.immutable and key in self.raw:
@@ -348,6 +615,7 @@ class Collection:
 		del self.raw[key]
 		if key in self.defined_in_file:
 			del self.defined_in_file[key]
+		self.invalidate(key)
 
 	def __getitem__(self, element):
 		return self.expand(element)
@@ -381,164 +649,176 @@ class Collection:
 				missing.append(key)
 		return missing
 
-	def skip_block(self, openfile=None):
+	def compile_file(self, filename, text):
+
+		# compile_file() turns the contents of a file into a list of parse operations, without touching any of our
+		# state. The operations are applied to the collection by apply_ops(). Splitting parsing up like this allows
+		# the operations for a file to be cached on disk, since they only depend on the file's contents. Ops are:
+		#
+		# [ "option", lax ] - an [option parse/lax] or [option parse/strict] annotation
+		# [ "var", key, value, section, conditional, line ] - an element definition. value is a list for multi-line
+		#   elements. section is the section name to record in self.section_for, or None.
+		# [ "collect", item, conditional ] - a [collect] annotation.
+
+		ops = []
+		section = ""
+		conditional = None
+		openfile = io.StringIO(text, newline=None)
 		while 1:
 			curline = openfile.readline()
+			if curline == "":  # EOF
+				break
+			# get list of words separated by whitespace
 			mysplit = curline[:-1].strip().split(" ")
-			if len(mysplit) == 0:
-				continue
-			if mysplit[0] == "}":
-				return
-			else:
+			if len(mysplit) == 1 and mysplit[0] == '':
+				# blank line
 				continue
+			# strip comments
+			spos = 0
+			while 1:
+				if spos >= len(mysplit):
+					break
+				if len(mysplit[spos]) == 0:
+					spos += 1
+					continue
+				if mysplit[spos][0] == "#":
+					mysplit = mysplit[0:spos]
+					break
+				spos += 1
 
-	def parseline(self, filename, openfile=None, dups=False):
+			if len(mysplit) == 0:
+				continue
 
-		# parseline() will parse a line and return None on EOF, return [] on a blank line with no data, or will
-		# return a list of string elements if there is data on the line, split along whitespace: [ "foo:", "bar", "oni" ]
-		# parseline() will also remove "# comments" from a line as appropriate
-		# parseline() will update self.raw with new data as it finds it.
-		if type(openfile) == bytes:
-			curline = openfile + '\n'
-		else:
-			curline = openfile.readline()
-		if curline == "":  # EOF
-			return None
-		# get list of words separated by whitespace
-		mysplit = curline[:-1].strip().split(" ")
-		if len(mysplit) == 1 and mysplit[0] == '':
-			# blank line
-			return []
-		# strip comments
-		spos = 0
-		while 1:
-			if spos >= len(mysplit):
-				break
-			if len(mysplit[spos]) == 0:
-				spos += 1
+			# parse elements
+			if len(mysplit[0]) == 0:
+				# not an element
 				continue
-			if mysplit[spos][0] == "#":
-				mysplit = mysplit[0:spos]
-				break
-			spos += 1
-
-		if len(mysplit) == 0:
-			return []
-
-		# parse elements
-		if len(mysplit[0]) == 0:
-			# not an element
-			return []
-
-		if len(mysplit) == 2 and mysplit[0][-1] == ":" and mysplit[1] == "[":
-			# for myvar, remove trailing colon:
-			myvar = mysplit[0][:-1]
-			if self.section:
-				myvar = self.section + "/" + myvar
-				self.section_for[myvar] = self.section
-			self.lax_vars[myvar] = self.lax
-			mylines = []
-			while 1:
-				curline = openfile.readline()
-				if curline == "":
-					raise KeyError("Error - incomplete [[ multi-line block,")
-				mysplit = curline[:-1].strip().split(" ")
-				if len(mysplit) == 1 and mysplit[0] == "]":
-					# record value and quit
-					# FIXME - MISSING COND HERE!?!?!?
-					if self.conditional:
-						if myvar not in self.conditionals:
-							self.conditionals[myvar] = {}
-						if self.conditional in self.conditionals[myvar]:
-							raise FlexDataError("Conditional element %s already defined for condition %s" % (myvar, self.conditional))
-						self.conditionals[myvar][self.conditional] = mylines
-					elif not dups and myvar in self.raw:
-						if self.defined_in_file[myvar] == filename:
-							raise FlexDataError("Error - file %s was already collected, duplicate definitions." % filename)
+
+			if len(mysplit) == 2 and mysplit[0][-1] == ":" and mysplit[1] == "[":
+				# for myvar, remove trailing colon:
+				myvar = mysplit[0][:-1]
+				mysection = None
+				if section:
+					myvar = section + "/" + myvar
+					mysection = section
+				mylines = []
+				while 1:
+					curline = openfile.readline()
+					if curline == "":
+						raise KeyError("Error - incomplete [[ multi-line block,")
+					mysplit = curline[:-1].strip().split(" ")
+					if len(mysplit) == 1 and mysplit[0] == "]":
+						ops.append(["var", myvar, mylines, mysection, conditional, None])
+						break
+					else:
+						# append new line
+						mylines.append(curline[:-1])
+			elif mysplit[0][0] == "[" and mysplit[-1][-1] == "]":
+				# possible section
+				mysplit[0] = mysplit[0][1:]
+				mysplit[-1] = mysplit[-1][:-1]
+				mysection = ' '.join(mysplit).split()
+				if mysection[0] == "section":
+					section = mysection[1]
+					if len(mysection) > 2:
+						if mysection[2] != "when":
+							raise FlexDataError("Expecting \"when\": " + curline[:-1])
+						conditional = " ".join(mysection[3:])
+						if conditional == "*":
+							conditional = None
+					elif len(mysection) == 2:
+						# clear conditional:
+						conditional = None
+					else:
+						raise FlexDataError("Invalid section specifier: " + curline[:-1])
+				elif mysection[0] == "option":
+					if mysection[1] == "parse/lax":
+						ops.append(["option", True])
+					elif mysection[1] == "parse/strict":
+						ops.append(["option", False])
+					else:
+						raise FlexDataError("Unexpected option in [option ] section: %s" % mysection[1])
+				elif mysection[0] == "when":
+					# conditional block
+					conditional = " ".join(mysection[1:])
+					if conditional == "*":
+						conditional = None
+				elif mysection[0] == "collect":
+					if conditional:
+						# This part of the code handles a [collect] annotation that appears inside a [when] block - we use the [when] condition in this case
+						if len(mysection) >= 3:
+							raise FlexDataError("Conditional collect annotations not allowed inside \"when\" annotations: %s" % repr(mysection))
+						ops.append(["collect", mysection[1], conditional])
+					elif len(mysection) > 3:
+						if mysection[2] == "when":
+							# even with a conditional, we still put the thing on the main collector list:
+							ops.append(["collect", mysection[1], " ".join(mysection[3:])])
 						else:
-							raise FlexDataError("Error - in parsing %s: \"%s\" already defined in %s" % (filename, myvar, self.defined_in_file[myvar]))
+							raise FlexDataError("Ow, [collect] clause seems invalid")
+					elif len(mysection) == 2:
+						ops.append(["collect", mysection[1], None])
 					else:
-						self.raw[myvar] = mylines
-						self.defined_in_file[myvar] = filename
-					break
+						raise FlexDataError("Ow, [collect] expects 1 or 4+ arguments.")
 				else:
-					# append new line
-					mylines.append(curline[:-1])
-		elif mysplit[0][0] == "[" and mysplit[-1][-1] == "]":
-			# possible section
-			mysplit[0] = mysplit[0][1:]
-			mysplit[-1] = mysplit[-1][:-1]
-			mysection = ' '.join(mysplit).split()
-			if mysection[0] == "section":
-				self.section = mysection[1]
-				if len(mysection) > 2:
-					if mysection[2] != "when":
-						raise FlexDataError("Expecting \"when\": " + curline[:-1])
-					self.conditional = " ".join(mysection[3:])
-					if self.conditional == "*":
-						self.conditional = None
-				elif len(mysection) == 2:
-					# clear conditional:
-					self.conditional = None
-				else:
-					raise FlexDataError("Invalid section specifier: " + curline[:-1])
-			elif mysection[0] == "option":
-				if mysection[1] == "parse/lax":
-					self.lax = True
-				elif mysection[1] == "parse/strict":
-					self.lax = False
-				else:
-					raise FlexDataError("Unexpected option in [option ] section: %s" % mysection[1])
-			elif mysection[0] == "when":
-				# conditional block
-				self.conditional = " ".join(mysection[1:])
-				if self.conditional == "*":
-					self.conditional = None
-			elif mysection[0] == "collect":
-				if self.conditional:
-					# This part of the code handles a [collect] annotation that appears inside a [when] block - we use the [when] condition in this case
-					if len(mysection) >= 3:
-						raise FlexDataError("Conditional collect annotations not allowed inside \"when\" annotations: %s" % repr(mysection))
-					self.collector_cond[mysection[1]] = self.conditional
-					# append what to collect, followed by the filename that the collect annotation appeared in. We will use this later, for
-					# expanding relative paths.
-					self.collector.append([mysection[1], filename]),
-				elif len(mysection) > 3:
-					if mysection[2] == "when":
-						self.collector_cond[mysection[1]] = " ".join(mysection[3:])
-						# even with a conditional, we still put the thing on the main collector list:
-						self.collector.append([mysection[1], filename])
-					# self.collector.append(mysection[1])
-					else:
-						raise FlexDataError("Ow, [collect] clause seems invalid")
-				elif len(mysection) == 2:
-					self.collector.append([mysection[1], filename])
+					raise FlexDataError("Invalid annotation: %s in %s" % (mysection[0], curline[:-1]))
+			elif mysplit[0][-1] == ":":
+				# basic element - rejoin all data elements with spaces
+				mykey = mysplit[0][:-1]
+				mysection = None
+				if mykey == "":
+					# ":" tag
+					mykey = section
+				elif section:
+					mykey = section + "/" + mykey
+					mysection = section
+				ops.append(["var", mykey, " ".join(mysplit[1:]), mysection, conditional, curline[:-1]])
+		return ops
+
+	def apply_ops(self, filename, ops, dups=False):
+
+		# apply_ops() will update self.raw, self.conditionals and the collector with the operations generated by
+		# compile_file() for filename. It returns a list of the variable names that were defined.
+
+		defined = []
+		for op in ops:
+			if op[0] == "option":
+				self.lax = op[1]
+			elif op[0] == "collect":
+				myitem, cond = op[1:]
+				if cond is not None:
+					self.collector_cond[myitem] = cond
+				# append what to collect, followed by the filename that the collect annotation appeared in. We will use
+				# this later, for expanding relative paths.
+				self.collector.append([myitem, filename])
+			elif op[0] == "var":
+				mykey, myvalue, mysection, cond, curline = op[1:]
+				self.invalidate(mykey)
+				defined.append(mykey)
+				if mysection is not None:
+					self.section_for[mykey] = mysection
+				self.lax_vars[mykey] = self.lax
+				if cond:
+					if mykey in self.conditionals and cond in self.conditionals[mykey]:
+						raise FlexDataError("Conditional element %s already defined for condition %s" % (mykey, cond))
+					# conditional dicts may be shared with an overlay() of this collection, so don't modify them in place:
+					myconds = dict(self.conditionals.get(mykey, {}))
+					myconds[cond] = myvalue
+					self.conditionals[mykey] = myconds
+				elif type(myvalue) == list:
+					if not dups and mykey in self.raw:
+						if self.defined_in_file[mykey] == filename:
+							raise FlexDataError("Error - file %s was already collected, duplicate definitions." % filename)
+						else:
+							raise FlexDataError("Error - in parsing %s: \"%s\" already defined in %s" % (filename, mykey, self.defined_in_file[mykey]))
+					self.raw[mykey] = myvalue
+					self.defined_in_file[mykey] = filename
 				else:
-					raise FlexDataError("Ow, [collect] expects 1 or 4+ arguments.")
-			else:
-				raise FlexDataError("Invalid annotation: %s in %s" % (mysection[0], curline[:-1]))
-		elif mysplit[0][-1] == ":":
-			# basic element - rejoin all data elements with spaces and add to self.raw
-			mykey = mysplit[0][:-1]
-			if mykey == "":
-				# ":" tag
-				mykey = self.section
-			elif self.section:
-				mykey = self.section + "/" + mykey
-				self.section_for[mykey] = self.section
-			self.lax_vars[mykey] = self.lax
-			myvalue = " ".join(mysplit[1:])
-			if self.conditional:
-				if mykey not in self.conditionals:
-					self.conditionals[mykey] = {}
-				if self.conditional in self.conditionals[mykey]:
-					raise FlexDataError("Conditional element %s already defined for condition %s" % (mykey, self.conditional))
-				self.conditionals[mykey][self.conditional] = myvalue
+					if not dups and mykey in self.raw:
+						raise FlexDataError("Error - \"" + mykey + "\" already defined. Value: %s. New line: %s." % (repr(self.raw[mykey]), curline))
+					self.raw[mykey] = myvalue
 			else:
-				if not dups and mykey in self.raw:
-					raise FlexDataError("Error - \"" + mykey + "\" already defined. Value: %s. New line: %s." % (repr(self.raw[mykey]), curline[:-1]))
-				self.raw[mykey] = myvalue
-		return mysplit
+				raise FlexDataError("Invalid parse operation %s in %s" % (repr(op), filename))
+		return defined
 
 	def collect(self, filename, origfile):
 		if not os.path.isabs(filename):
@@ -548,118 +828,328 @@ class Collection:
 			raise IOError("File '" + filename + "' does not exist.")
 		if not os.path.isfile(filename):
 			raise IOError("File to be parsed '" + filename + "' is not a regular file.")
-		self.conditional = None
-		openfile = open(filename, "r")
-		self.section = ""
-		while 1:
-			out = self.parseline(filename, openfile)
-			if out is None:
-				break
-		openfile.close()
+		ops = None
+		if self.parse_cache is not None:
+			ops = self.parse_cache.get(filename, self.compile_file)
+		if ops is None:
+			with open(filename, "r") as openfile:
+				ops = self.compile_file(filename, openfile.read())
+		defined = self.apply_ops(filename, ops)
 		# add to our list of parsed files
 		if self.debug:
 			sys.stdout.write("Debug: collected: %s\n" % os.path.normpath(filename))
 		self.collected.append(os.path.normpath(filename))
+		return defined
+
+	def parse_condition(self, cond):
+		"""Turn a condition like "target is stage1 stage2" into a (variable, values) predicate. values is None for a
+		condition like "foo" that just tests whether a variable is defined. Predicates are cached in self.predicates,
+		since the same conditions get tested over and over again."""
+		if cond in self.predicates:
+			return self.predicates[cond]
+		mysplit = cond.split()
+		if len(mysplit) == 1:
+			predicate = (mysplit[0], None)
+		elif len(mysplit) == 0:
+			raise FlexDataError("Condition " + repr(mysplit) + " is invalid")
+		elif len(mysplit) >= 3 and mysplit[1] in ["is", "in"]:
+			predicate = (mysplit[0], tuple(mysplit[2:]))
+		elif len(mysplit) >= 3:
+			raise FlexDataError("Expecting 'is' or 'in' in %s" % mysplit)
+		else:
+			raise FlexDataError("Invalid condition")
+		self.predicates[cond] = predicate
+		return predicate
 
 	def condition_on_conditional(self, cond):
 		"""defining a conditial var based on another conditional var is illegal. This function will tell us if we are in this mess."""
 		if cond is None:
 			return False
-		cond = cond.split()
-		if len(cond) == 1:
-			if cond[0] in self.raw:
-				return False
-			elif cond[0] in self.conditionals:
-				return True
-			else:
-				# undefined
-				return False
-		elif len(cond) == 0:
-			raise FlexDataError("Condition %s is invalid" % cond)
-		elif len(cond) >= 3:
-			if cond[1] not in ["is", "in"]:
-				raise FlexDataError("Expecting 'is' or 'in' in %s" % cond)
-			if cond[0] in self.raw:
-				return False
-			elif cond[0] in self.conditionals:
-				return True
-			else:
-				# undefined
-				return False
-
-	def condition_true(self, cond):
-		cond = cond.split()
-		if len(cond) == 1:
-			if cond[0] in self.raw:
-				return True
-			else:
-				return False
-		elif len(cond) == 0:
-			raise FlexDataError("Condition " + repr(cond) + " is invalid")
-		elif len(cond) >= 3 and cond[1] in ["is", "in"]:
-			if cond[0] not in self.raw:
-				# maybe it's not defined
-				return False
-			# loop over multiple values, such as "target is ~x86 x86 amd64", if one is equal, then it's true
-			for curcond in cond[2:]:
-				if self[cond[0]] == curcond:
-					return True
+		testvar, values = self.parse_condition(cond)
+		if testvar in self.raw:
 			return False
+		elif testvar in self.conditionals:
+			return True
 		else:
-			raise FlexDataError("Invalid condition")
+			# undefined
+			return False
 
-	def run_collector(self):
-		# BUG? we may need to have an expandString option that will disable the ability to go to the evaluated dict,
-		# because as we parse new files, we have new data and some "lax" evals may evaluate correctly now.
+	def condition_true(self, cond):
+		testvar, values = self.parse_condition(cond)
+		self.depends_on(testvar)
+		if testvar not in self.raw:
+			# maybe it's not defined
+			return False
+		if values is None:
+			return True
+		# multiple values, such as "target is ~x86 x86 amd64" -- if one is equal, then it's true
+		return self[testvar] in values
 
+	def run_collector(self, defer=None):
 		# BUG: detect if we are trying to collect a single file multiple times. :)
 
-		# contfails means "continuous expansion failures" - if we get to the point where we are not making progress,
-		# ie. contfails >= len(self.collector), then abort with a failure as we can't expand our cute little variable.
-		contfails = 0
+		# Each [collect] annotation on the collector list is tried in turn. If it can't be expanded yet, or its
+		# condition isn't true yet, we record every variable it looked at and put it aside until one of those variables
+		# gets defined by a file we collect -- so an annotation is only retried when it has a chance of succeeding.
+		# Annotations that never become ready are left on self.collector, and self.collector_waiting maps each of them
+		# to the undefined variables it is waiting for.
+
+		# defer, if specified, is a list of variable names that will be defined later, in an overlay() of this
+		# collection. Any [collect] annotation that depends on one of these variables, or on the contents of a file,
+		# is left on the collector list for the overlay to process.
+
+		items = self.collector
+		self.collector = []
+		ready = deque(range(len(items)))
+		# waiting maps a variable name to the items that will be retried when it's defined. blocked maps items to the
+		# last reason they couldn't be collected -- a list of undefined variables, or an error message.
+		waiting = {}
+		blocked = {}
+		deferred = []
 		oldlax = self.lax
 		self.lax = False
-		while len(self.collector) != 0 and contfails < len(self.collector):
-			# grab the first item from our collector list
+		while ready:
+			pos = ready.popleft()
 			try:
-				myitem, origfile = self.collector[0]
+				myitem, origfile = items[pos]
 			except ValueError:
-				raise FlexDataError(repr(self.collector[0]) + " does not appear to be good")
-			if myitem in self.collector_cond:
-				cond = self.collector_cond[myitem]
-				if self.condition_on_conditional(cond):
-					raise FlexDataError(f"Collect annotation {myitem} has conditional {cond} that references a conditional variable, which is not allowed.")
+				raise FlexDataError(repr(items[pos]) + " does not appear to be good")
+			myexpand = None
+			error = None
+			deps = set()
+			self.dep_stack.append(deps)
+			try:
+				if myitem in self.collector_cond:
+					cond = self.collector_cond[myitem]
+					if self.condition_on_conditional(cond):
+						raise FlexDataError(f"Collect annotation {myitem} has conditional {cond} that references a conditional variable, which is not allowed.")
 					# is the condition true?:
-				if not self.condition_true(cond):
-					contfails += 1
-					self.collector = self.collector[1:] + [self.collector[0]]
-					continue
+					is_ready = self.condition_true(cond)
 				else:
+					is_ready = True
+				if is_ready:
 					try:
 						myexpand = self.expand_string(mystring=myitem)
-					except KeyError:
-						contfails += 1
-						self.collector = self.collector[1:] + [self.collector[0]]
-						continue
-					self.collect(myexpand, origfile)
-					self.collector = self.collector[1:]
-					contfails = 0
-			else:
-				try:
-					myexpand = self.expand_string(mystring=myitem)
-				except KeyError:
-					contfails += 1
-					# move failed item to back of list
-					self.collector = self.collector[1:] + [self.collector[0]]
-					continue
-				# read in data:
-				if myexpand not in ["", None]:
-					# if expands to blank, with :zap, we skip it: (a silly fix for now)
-					self.collect(myexpand, origfile)
-				# we already parsed it, so remove filename from list:
-				self.collector = self.collector[1:]
-				# reset continuous fail counter, we are making progress:
-				contfails = 0
+					except KeyError as e:
+						is_ready = False
+						if str(e.args[0]).startswith("Circular reference"):
+							error = e.args[0]
+			finally:
+				self.dep_stack.pop()
+			if defer and (None in deps or deps.intersection(defer)):
+				blocked.pop(pos, None)
+				deferred.append(pos)
+				continue
+			if not is_ready:
+				blocked[pos] = error if error else sorted(dep for dep in deps if dep not in self)
+				for dep in deps:
+					if dep is not None:
+						if dep not in waiting:
+							waiting[dep] = []
+						waiting[dep].append(pos)
+				continue
+			blocked.pop(pos, None)
+			defined = []
+			# read in data:
+			if myitem in self.collector_cond or myexpand not in ["", None]:
+				# if expands to blank, with :zap, we skip it: (a silly fix for now)
+				defined = self.collect(myexpand, origfile)
+			# the file we just collected may have new [collect] annotations of its own:
+			for newitem in self.collector:
+				items.append(newitem)
+				ready.append(len(items) - 1)
+			self.collector = []
+			# wake up anything that was waiting for a variable we just defined:
+			for varname in defined:
+				for waiter in waiting.pop(varname, []):
+					if waiter in blocked and waiter not in ready:
+						ready.append(waiter)
+		self.collector = [items[pos] for pos in sorted(blocked)] + [items[pos] for pos in deferred]
+		self.collector_waiting = {items[pos][0]: blocked[pos] for pos in blocked}
 		self.lax = oldlax
+		if defer is None:
+			cycles = [reason for reason in self.collector_waiting.values() if type(reason) == str]
+			if cycles:
+				raise FlexDataError("Unable to collect files due to circular references: " + "; ".join(cycles))
+		if self.debug:
+			for myitem, reason in self.collector_waiting.items():
+				sys.stdout.write("Debug: not collected: %s (waiting for %s)\n" % (myitem, reason))
+
+	def overlay(self):
+		"""Return a new collection layered on top of this one. The overlay starts out with all of our data, and can
+		have variables set and files collected without affecting us. Values are shared rather than copied, so this
+		is cheap -- only the tables that map names to values are copied."""
+		child = Collection(self.debug, parse_cache=self.parse_cache)
+		child.immutable = self.immutable
+		child.lax = self.lax
+		child.raw = self.raw.copy()
+		child.conditionals = self.conditionals.copy()
+		child.blanks = self.blanks.copy()
+		child.defined_in_file = self.defined_in_file.copy()
+		child.lax_vars = self.lax_vars.copy()
+		child.collected = self.collected[:]
+		child.read_files = self.read_files.copy()
+		child.section_for = self.section_for.copy()
+		child.collector = self.collector[:]
+		child.collector_cond = self.collector_cond.copy()
+		# predicates and templates only depend on the string they were compiled from, so they can be shared:
+		child.predicates = self.predicates
+		child.templates = self.templates
+		child.embedded = self.embedded
+		return child
+
+	def freeze(self):
+		"""Expand every variable and return the results as a FrozenCollection, which can be shared between threads."""
+		values = {}
+		errors = {}
+		mykeys = self.keys()
+		for key in mykeys:
+			# we store both "foo" and "foo?":
+			for element in [key, key + "?"]:
+				try:
+					value = self[element]
+				except Exception as e:
+					errors[element] = e
+				else:
+					values[element] = tuple(value) if type(value) == list else value
+		lax_undefined = [key for key, lax in self.lax_vars.items() if lax and key not in values and key not in errors]
+		return FrozenCollection(mykeys, values, errors, lax_undefined, self.raw.keys(), self.blanks, self.collected, self.read_files)
+
+
+class FrozenCollection:
+
+	"""
+	A FrozenCollection is an immutable snapshot of a Collection, created by Collection.freeze(). Every variable has
+	already been expanded, so looking one up is just a dictionary lookup, and nothing is modified by reading. This
+	means a FrozenCollection can be shared by any number of threads without locking.
+
+	The only thing a lookup can record is a blank -- an undefined "lax" variable that expanded to the empty string.
+	These are recorded per thread, and self.blanks returns the blanks found while freezing plus those found by the
+	current thread.
+	"""
+
+	def __init__(self, keys, values, errors, lax_undefined, raw_keys, blanks, collected, read_files):
+		self.key_list = tuple(keys)
+		self.key_set = frozenset(keys)
+		self.values = values
+		self.errors = errors
+		self.lax_undefined = frozenset(lax_undefined)
+		self.raw_keys = frozenset(raw_keys)
+		self.frozen_blanks = frozenset(blanks)
+		self.collected = tuple(collected)
+		self.read_files = tuple(read_files)
+		self.local = threading.local()
+		# see overlay():
+		self.overrides = None
+
+	def to_dict(self):
+		"""Return our contents as a dict that can be serialized as JSON, and loaded again using from_dict()."""
+		errors = {}
+		for key, e in self.errors.items():
+			errors[key] = [type(e).__name__, [arg if type(arg) in [str, int] else str(arg) for arg in e.args]]
+		return {
+			"keys": list(self.key_list),
+			"values": {key: list(value) if type(value) == tuple else value for key, value in self.values.items()},
+			"multi": [key for key, value in self.values.items() if type(value) == tuple],
+			"errors": errors,
+			"lax_undefined": sorted(self.lax_undefined),
+			"raw_keys": sorted(self.raw_keys),
+			"blanks": sorted(self.frozen_blanks),
+			"collected": list(self.collected),
+			"read_files": list(self.read_files)
+		}
+
+	@classmethod
+	def from_dict(cls, data):
+		values = data["values"]
+		for key in data["multi"]:
+			values[key] = tuple(values[key])
+		errors = {}
+		for key, (clsname, args) in data["errors"].items():
+			errcls = getattr(builtins, clsname, None)
+			if type(errcls) != type or not issubclass(errcls, Exception):
+				errcls = FlexDataError
+			errors[key] = cls.make_error(errcls, args)
+		return cls(data["keys"], values, errors, data["lax_undefined"], data["raw_keys"], data["blanks"], data["collected"], data["read_files"])
+
+	@staticmethod
+	def make_error(errcls, args):
+		# return errcls(*args), without calling errcls.__init__() -- FlexDataError's prints the message, which has
+		# already been printed when the error first happened:
+		e = errcls.__new__(errcls)
+		e.args = tuple(args)
+		return e
+
+	def overlay(self):
+		"""
+		Return a copy of this snapshot that new values can be set on. We stay untouched. Values set on the copy are
+		stored as-is, without expansion, and nothing that was expanded when the snapshot was frozen changes.
+		"""
+		child = FrozenCollection.__new__(FrozenCollection)
+		child.__dict__.update(self.__dict__)
+		child.local = threading.local()
+		child.overrides = {}
+		return child
+
+	@property
+	def blanks(self):
+		myblanks = dict.fromkeys(self.frozen_blanks, True)
+		myblanks.update(getattr(self.local, "blanks", {}))
+		return myblanks
+
+	def __getitem__(self, element):
+		if self.overrides and element in self.overrides:
+			return self.overrides[element]
+		if element in self.values:
+			value = self.values[element]
+			return list(value) if type(value) == tuple else value
+		if element in self.errors:
+			# raise a new copy of the exception, since several threads may be raising it at once:
+			e = self.errors[element]
+			raise self.make_error(type(e), e.args)
+		if element[-1] == "?":
+			return "no"
+		if element in self.lax_undefined:
+			# record that we looked up an undefined element
+			if not hasattr(self.local, "blanks"):
+				self.local.blanks = {}
+			self.local.blanks[element] = True
+			return ""
+		raise FlexDataError("Variable \"" + element + "\" not found foo")
+
+	def __setitem__(self, key, value):
+		if self.overrides is None:
+			raise IndexError("Attempting to redefine " + key + " in frozen settings.")
+		self.overrides[key] = value
+
+	def __delitem__(self, key):
+		raise IndexError("Attempting to delete " + key + " from frozen settings.")
+
+	def __contains__(self, key):
+		return key in self.key_set or (self.overrides is not None and key in self.overrides)
+
+	def has_key(self, key):
+		return self.__contains__(key)
+
+	def keys(self):
+		mylist = list(self.key_list)
+		if self.overrides:
+			mylist += [key for key in self.overrides if key not in self.key_set]
+		return mylist
+
+	def missing(self, keylist):
+		return [key for key in keylist if key not in self.raw_keys]
+
+	def is_multi(self, myvar):
+		return type(self.values.get(myvar)) == tuple
+
+	def iter_multi(self, myvar):
+		multi = self[myvar]
+		if type(multi) != list:
+			raise FlexDataError("expandMulti received non-multi")
+		yield from multi
+
+	def expand_multi(self, myvar):
+		return list(self.iter_multi(myvar))
 
 # vim: ts=4 sw=4 noet
@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from metro_support import MetroError
+
+
+def daemon_request(socket_path, request):
+	"""Send request (a dict) to the metro daemon listening on socket_path, and return its reply."""
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socket_path)
+		sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+		data = b""
+		while not data.endswith(b"\n"):
+			chunk = sock.recv(65536)
+			if not chunk:
+				break
+			data += chunk
+	except OSError as e:
+		raise MetroError("Unable to talk to metro daemon at %s: %s" % (socket_path, e))
+	finally:
+		sock.close()
+	try:
+		reply = json.loads(data.decode("utf-8"))
+	except ValueError:
+		raise MetroError("Invalid reply from metro daemon at %s." % socket_path)
+	if "error" in reply:
+		raise MetroError(reply["error"])
+	return reply
+
+
+class MetroDaemon:
+
+	"""
+	MetroDaemon accepts build jobs on a UNIX socket, and runs up to workers of them at a time. Each job is run by
+	calling run_job(args) in a child process forked from the daemon, so it starts out with metro's modules loaded and
+	the daemon's parse cache warm. If prepare_job is given, the daemon calls prepare_job(args) just before forking a
+	job, so that work done there (such as parsing the job's base settings) is inherited by the job rather than repeated
+	in it. A job runs in its own session, so it can be cancelled by signalling its process group. Requests and replies
+	are single lines of JSON:
+
+	{"cmd": "submit", "args": {...}} - queue a build using the metro arguments in args. Replies with the new job.
+	{"cmd": "list"} - reply with all jobs.
+	{"cmd": "cancel", "id": id} - cancel a queued or running job. Replies with the job.
+	"""
+
+	max_finished = 100
+
+	def __init__(self, socket_path, log_path, workers, run_job, prepare_job=None):
+		self.socket_path = socket_path
+		self.log_path = log_path
+		self.workers = workers
+		self.run_job = run_job
+		self.prepare_job = prepare_job
+		self.jobs = {}
+		self.queue = []
+		# pid -> id of running jobs:
+		self.running = {}
+		self.next_id = 1
+		self.stamp = time.strftime("%Y%m%d-%H%M%S")
+		self.listener = None
+		self.selector = None
+		self.stopping = False
+
+	def serve(self):
+		if os.path.exists(self.socket_path):
+			try:
+				daemon_request(self.socket_path, {"cmd": "list"})
+			except MetroError:
+				# left behind by a daemon that is no longer running:
+				os.unlink(self.socket_path)
+			else:
+				raise MetroError("A metro daemon is already listening on %s." % self.socket_path)
+		os.makedirs(os.path.dirname(self.socket_path), mode=0o700, exist_ok=True)
+		os.makedirs(self.log_path, exist_ok=True)
+		self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.listener.bind(self.socket_path)
+		# only root (or whoever runs the daemon) can submit builds:
+		os.chmod(self.socket_path, 0o600)
+		self.listener.listen(16)
+		self.listener.setblocking(False)
+		self.selector = selectors.DefaultSelector()
+		self.selector.register(self.listener, selectors.EVENT_READ, self.accept)
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		print("Metro daemon listening on %s, running up to %s jobs at a time." % (self.socket_path, self.workers))
+		try:
+			while not self.stopping or self.running:
+				self.start_jobs()
+				for key, events in self.selector.select(timeout=1):
+					key.data(key.fileobj)
+				self.reap_jobs()
+		finally:
+			self.selector.close()
+			self.listener.close()
+			os.unlink(self.socket_path)
+
+	def stop(self, signum, frame):
+		if not self.stopping:
+			print("Metro daemon exiting -- cancelling %s running job(s)..." % len(self.running))
+			self.stopping = True
+			self.queue = []
+			for pid in self.running:
+				self.signal_job(pid)
+
+	def accept(self, listener):
+		try:
+			conn, addr = listener.accept()
+		except BlockingIOError:
+			return
+		# requests are tiny, so we read them in one go:
+		conn.settimeout(5)
+		with conn:
+			try:
+				data = b""
+				while not data.endswith(b"\n"):
+					chunk = conn.recv(65536)
+					if not chunk:
+						break
+					data += chunk
+				try:
+					reply = self.handle(json.loads(data.decode("utf-8")))
+				except (ValueError, KeyError, TypeError) as e:
+					reply = {"error": "Invalid request: %s" % e}
+				conn.sendall((json.dumps(reply) + "\n").encode("utf-8"))
+			except OSError:
+				pass
+
+	def handle(self, request):
+		cmd = request["cmd"]
+		if cmd == "submit":
+			args = request["args"]
+			for key, value in args.items():
+				if type(value) != str or key[-1:] != ":":
+					return {"error": "cmdline argument '%s' invalid - does not end in a colon" % key}
+			if self.stopping:
+				return {"error": "Metro daemon is exiting."}
+			job_id = str(self.next_id)
+			self.next_id += 1
+			self.jobs[job_id] = {
+				"id": job_id,
+				"args": args,
+				"state": "queued",
+				"pid": None,
+				"exitcode": None,
+				"submitted": time.time(),
+				"started": None,
+				"finished": None,
+				"log": os.path.join(self.log_path, "job-%s-%s.txt" % (self.stamp, job_id))
+			}
+			self.queue.append(job_id)
+			return {"job": self.jobs[job_id]}
+		elif cmd == "list":
+			return {"jobs": list(self.jobs.values())}
+		elif cmd == "cancel":
+			job = self.jobs.get(str(request["id"]))
+			if job is None:
+				return {"error": "No such job: %s" % request["id"]}
+			if job["state"] == "queued":
+				self.queue.remove(job["id"])
+				self.finish_job(job, "cancelled")
+			elif job["state"] == "running":
+				self.signal_job(job["pid"])
+				job["state"] = "cancelling"
+			else:
+				return {"error": "Job %s has already finished." % job["id"]}
+			return {"job": job}
+		return {"error": "Unknown command: %s" % cmd}
+
+	def signal_job(self, pid):
+		try:
+			os.killpg(pid, signal.SIGTERM)
+		except ProcessLookupError:
+			pass
+
+	def start_jobs(self):
+		while self.queue and len(self.running) < self.workers:
+			job = self.jobs[self.queue.pop(0)]
+			job["state"] = "running"
+			job["started"] = time.time()
+			if self.prepare_job is not None:
+				try:
+					self.prepare_job(job["args"])
+				except Exception:
+					# the job will run into the same problem, and report it in its log:
+					pass
+			job["pid"] = self.fork_job(job)
+			self.running[job["pid"]] = job["id"]
+
+	def fork_job(self, job):
+		logfile = open(job["log"], "w")
+		sys.stdout.flush()
+		sys.stderr.flush()
+		pid = os.fork()
+		if pid != 0:
+			logfile.close()
+			return pid
+		exitcode = 1
+		try:
+			os.setsid()
+			# a cancelled job gets SIGTERM, which cleans up (lock files, etc.) like ctrl-C does:
+			signal.signal(signal.SIGTERM, signal.default_int_handler)
+			signal.signal(signal.SIGINT, signal.default_int_handler)
+			self.selector.close()
+			self.listener.close()
+			os.dup2(logfile.fileno(), 1)
+			os.dup2(logfile.fileno(), 2)
+			exitcode = self.run_job(job["args"])
+		except SystemExit as e:
+			exitcode = e.code if type(e.code) == int else int(e.code is not None)
+		except BaseException:
+			traceback.print_exc()
+		finally:
+			sys.stdout.flush()
+			sys.stderr.flush()
+			os._exit(exitcode)
+
+	def reap_jobs(self):
+		while self.running:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				break
+			if pid == 0:
+				break
+			job = self.jobs[self.running.pop(pid)]
+			job["exitcode"] = os.waitstatus_to_exitcode(status)
+			if job["state"] == "cancelling" or self.stopping:
+				self.finish_job(job, "cancelled")
+			else:
+				self.finish_job(job, "done" if job["exitcode"] == 0 else "failed")
+
+	def finish_job(self, job, state):
+		job["state"] = state
+		job["finished"] = time.time()
+		finished = [job_id for job_id, myjob in self.jobs.items() if myjob["finished"] is not None]
+		for job_id in finished[:-self.max_finished]:
+			del self.jobs[job_id]
+
+
+def print_jobs(jobs):
+	for job in jobs:
+		args = " ".join("%s %s" % (key, value) for key, value in job["args"].items())
+		print("%-5s %-10s %s" % (job["id"], job["state"], args))
+		print("      log: %s" % job["log"])
+
+# vim: ts=4 sw=4 noet
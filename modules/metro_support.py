@@ -1,16 +1,31 @@
 #!/usr/bin/python3
 
+import contextlib
+import cProfile
+import ctypes
+import fcntl
 import grp
+import hashlib
+import itertools
 import json
+import lzma
+import mmap
 import os
 import pwd
+import queue
+import re
+import select
 import shutil
+import signal
+import socket
+import statistics
 import subprocess
 import sys
+import threading
 import time
 from importlib import import_module
 
-from flexdata import Collection
+from flexdata import Collection, FrozenCollection, ParseCache
 
 
 def ismount(path):
@@ -27,6 +42,118 @@ def ismount(path):
 	return 0
 
 
+_hostname = None
+
+
+def host_name():
+	"""Return the name of this host. It is looked up once per process."""
+	global _hostname
+	if _hostname is None:
+		_hostname = socket.gethostname()
+	return _hostname
+
+
+_nproc = None
+
+
+def host_nproc():
+	global _nproc
+	if _nproc is None:
+		_nproc = int(subprocess.getoutput("nproc --all"))
+	return _nproc
+
+
+def host_memory():
+	with open("/proc/meminfo", "r") as meminfo:
+		for line in meminfo:
+			if line.startswith("MemTotal:"):
+				return int(line.split()[1]) * 1024
+	return 0
+
+
+def parse_size(size):
+	"""Turn a size like "512M" into a number of bytes. None is returned as-is."""
+	if size is None:
+		return None
+	units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+	try:
+		if size[-1:].upper() in units:
+			return int(size[:-1]) * units[size[-1:].upper()]
+		return int(size)
+	except ValueError:
+		raise MetroError("Invalid size: %s" % size)
+
+
+def file_digest(path):
+	with open(path, "rb") as myfile:
+		return hashlib.sha256(myfile.read()).hexdigest()
+
+
+def source_digest(path):
+	"""Return file_digest(path), or None if path doesn't exist (yet) -- settings can depend on a file being missing."""
+	try:
+		return file_digest(path)
+	except FileNotFoundError:
+		return None
+
+
+class DirWatcher:
+
+	"""
+	DirWatcher lets us sleep until something is created, removed, renamed or written in a directory, such as a lock
+	file being removed. It uses inotify when it can, and otherwise falls back to sleeping for poll seconds at a time.
+	Create the watcher before checking whatever we are waiting for, so that no change can be missed.
+	"""
+
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_FROM = 0x40
+	IN_MOVED_TO = 0x80
+	IN_CREATE = 0x100
+	IN_DELETE = 0x200
+	IN_DELETE_SELF = 0x400
+
+	def __init__(self, path, poll=5):
+		self.poll = poll
+		self.fd = None
+		mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE | self.IN_DELETE_SELF
+		try:
+			libc = ctypes.CDLL(None, use_errno=True)
+			fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+			if fd < 0:
+				return
+			if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+				os.close(fd)
+				return
+			self.fd = fd
+		except (OSError, AttributeError):
+			pass
+
+	def wait(self, timeout):
+		"""Return once something changes in our directory, or after timeout seconds."""
+		if self.fd is None:
+			time.sleep(max(min(timeout, self.poll), 0))
+			return
+		ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+		if ready:
+			# we don't care what happened, just that something did -- so throw the events away:
+			try:
+				while os.read(self.fd, 4096):
+					pass
+			except BlockingIOError:
+				pass
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
 class MetroError(Exception):
 	def __init__(self, *args):
 		self.args = args
@@ -40,6 +167,8 @@ class MetroError(Exception):
 
 class MetroSetup(object):
 
+	bundle_version = 1
+
 	def __init__(self, verbose=False, debug=False):
 
 		self.debug = debug
@@ -48,18 +177,49 @@ class MetroSetup(object):
 		self.flexdata = import_module("flexdata")
 		self.targets = import_module("targets")
 		self.configfile = None
+		# parsed spec and conf files are cached here, so that short-lived metro commands don't re-parse everything:
+		cache_home = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+		self.parse_cache = ParseCache(os.path.join(cache_home, "metro", "parse"))
+		# base settings, keyed by command-line arguments -- see get_base_settings():
+		self.base_settings = {}
+		# targets can grab their settings from more than one thread -- see Metro.run_targets():
+		self.base_lock = threading.Lock()
+		# frozen settings loaded from a settings bundle, and the arguments they were compiled for -- see
+		# load_settings_bundle():
+		self.bundle = None
+		self.bundle_args = None
+		self.bundle_sources = None
 
-	def get_settings(self, args=None, extraargs=None):
+	def get_base_settings(self, args):
+		"""
+		Return the settings shared by all targets built with the command-line arguments args: ~/.metro, plus everything
+		it collects that doesn't depend on the target. These are parsed once and cached, and get_settings() returns
+		overlays of them.
+		"""
+		key = tuple(sorted(args.items()))
+		with self.base_lock:
+			if key not in self.base_settings:
+				self.base_settings[key] = self.parse_base_settings(args)
+			return self.base_settings[key]
 
-		if args is None:
-			args = {}
+	def reload_base_settings(self, args):
+		"""
+		Parse the base settings for args again, in case the files they came from have changed, and cache them in place of
+		everything we have cached. The metro daemon calls this before forking each job, so that the job starts out with
+		its settings parsed, while the daemon only ever keeps one job's worth of them.
+		"""
+		settings = self.parse_base_settings(args)
+		with self.base_lock:
+			self.base_settings = {tuple(sorted(args.items())): settings}
+
+	def parse_base_settings(self, args):
 
 		self.configfile = os.path.expanduser("~/.metro")
 		# config settings setup
 
 		if self.verbose:
 			print("Using main configuration file %s.\n" % self.configfile)
-		settings = self.flexdata.Collection(self.debug)
+		settings = self.flexdata.Collection(self.debug, parse_cache=self.parse_cache)
 
 		if os.path.exists(self.configfile):
 			settings.collect(self.configfile, None)
@@ -68,31 +228,516 @@ class MetroSetup(object):
 			raise RuntimeError("config file '%s' not found\nPlease copy %s to ~/.metro and customize for your environment." %
 				(self.configfile, (os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + "/metro.conf")))
 
-		for key, value in list(args.items()):
-			if key[-1] == ":":
-				settings[key[:-1]] = value
+		for key_arg, value in list(args.items()):
+			if key_arg[-1] == ":":
+				settings[key_arg[:-1]] = value
 			else:
-				raise RuntimeError("cmdline argument '%s' invalid - does not end in a colon" % key)
+				raise RuntimeError("cmdline argument '%s' invalid - does not end in a colon" % key_arg)
+
+		# anything that depends on the target gets collected in the overlay returned by get_settings():
+		settings.run_collector(defer=["target"])
+		return settings
+
+	def get_settings(self, args=None, extraargs=None, grant=None):
+		"""
+		Return the settings for args, plus the values in extraargs (typically, "target".) If grant is set, it is a slot
+		reserved using HostSlots, and MAKEOPTS and emerge/options are sized to fit it rather than the whole host.
+		"""
+
+		if args is None:
+			args = {}
+
+		if self.bundle is not None and args == self.bundle_args and grant is None:
+			target = ""
+			if extraargs:
+				target = extraargs.get("target", None) if list(extraargs.keys()) == ["target"] else None
+			if target in self.bundle and self.bundle_current(self.bundle[target]):
+				return self.bundle[target].overlay()
+
+		settings = self.get_base_settings(args).overlay()
 
 		# add extra values
 		if extraargs:
 			for arg in list(extraargs.keys()):
 				settings[arg] = extraargs[arg]
 		settings.run_collector()
+		cpus = grant["cpus"] if grant else host_nproc()
 		if settings["portage/MAKEOPTS"] == "auto":
-			settings["portage/MAKEOPTS"] = "-j%s" % (int(subprocess.getoutput("nproc --all")) + 1)
+			jobs = cpus
+			if grant:
+				# allow for about 2GB of memory per compiler job:
+				jobs = max(min(cpus, grant["mem"] // (2 << 30)), 1)
+			settings["portage/MAKEOPTS"] = "-j%s" % (jobs + 1)
+		if "emerge/options" in settings:
+			options = settings["emerge/options"]
+			if grant:
+				# emerge is sized to fit our slot, whatever emerge/options says:
+				options = re.sub(r"--jobs=\S+", "--jobs=%s" % max(cpus // 4, 1), options)
+				options = re.sub(r"--load-average=\S+", "--load-average=%s" % cpus, options)
+			else:
+				options = options.replace("--jobs=auto", "--jobs=4").replace("--load-average=auto", "--load-average=4")
+			if options != settings["emerge/options"]:
+				settings["emerge/options"] = options
 
 		return settings
 
+	def get_slots(self, settings):
+		"""Return the HostSlots shared by builds on this host, or None if host/slots isn't set."""
+		if "host/slots" not in settings or int(settings["host/slots"]) < 1:
+			return None
+		return HostSlots(os.path.join(settings["path/tmp"], "slots"), int(settings["host/slots"]))
+
+	def write_settings_bundle(self, path, args, targetlist):
+		"""
+		Fully resolve the settings for args, and for each target in targetlist, and write them to path as JSON, along
+		with the hashes of every file they were read from. A bundle can be loaded by load_settings_bundle(), so that
+		metro commands run with the same arguments don't need to parse or expand anything.
+		"""
+		bundle = {
+			"version": self.bundle_version,
+			"args": args,
+			"nproc": host_nproc(),
+			"sources": {},
+			"settings": {}
+		}
+		for target in [""] + targetlist:
+			if target in bundle["settings"]:
+				continue
+			settings = self.get_settings(args, {"target": target} if target else None)
+			frozen = settings.freeze()
+			bundle["settings"][target] = frozen.to_dict()
+			for filename in frozen.collected + frozen.read_files:
+				if filename not in bundle["sources"]:
+					bundle["sources"][filename] = source_digest(filename)
+		tmp_path = "%s.%s.tmp" % (path, os.getpid())
+		with open(tmp_path, "w") as outf:
+			json.dump(bundle, outf)
+		os.replace(tmp_path, path)
+
+	def bundle_current(self, frozen):
+		"""
+		Files read using "<<", such as .control/version/stage3, can be updated (or created) by the targets we build.
+		Return False if any of the ones frozen depends on have changed since our settings bundle was loaded.
+		"""
+		for filename in frozen.read_files:
+			try:
+				if source_digest(filename) == self.bundle_sources[filename]:
+					continue
+			except IOError:
+				pass
+			return False
+		return True
+
+	def load_settings_bundle(self, path, args):
+		"""
+		Load a settings bundle written by write_settings_bundle(). If it is still valid for args -- it was compiled
+		with the same arguments, on a host with the same number of CPUs, and none of its source files have changed --
+		get_settings() will return its settings from now on, and we return True. Otherwise, we return False, and
+		settings are parsed as usual.
+		"""
+		try:
+			with open(path, "r") as inf:
+				bundle = json.load(inf)
+		except (IOError, ValueError) as e:
+			sys.stderr.write("Unable to load settings bundle %s: %s\n" % (path, e))
+			return False
+		reason = None
+		if bundle.get("version") != self.bundle_version:
+			reason = "bundle version %s is not supported" % bundle.get("version")
+		elif bundle["args"] != args:
+			reason = "it was compiled with different arguments"
+		elif bundle["nproc"] != host_nproc():
+			# MAKEOPTS may have been derived from the number of CPUs:
+			reason = "it was compiled on a host with %s CPUs" % bundle["nproc"]
+		else:
+			for filename, digest in bundle["sources"].items():
+				try:
+					if source_digest(filename) == digest:
+						continue
+				except IOError:
+					pass
+				reason = "%s has changed" % filename
+				break
+		if reason is not None:
+			sys.stderr.write("Not using settings bundle %s: %s.\n" % (path, reason))
+			return False
+		self.bundle = {target: FrozenCollection.from_dict(data) for target, data in bundle["settings"].items()}
+		self.bundle_args = args
+		self.bundle_sources = bundle["sources"]
+		if self.verbose:
+			print("Using settings bundle %s.\n" % path)
+		return True
+
+
+class HostSlots:
+
+	"""
+	HostSlots divides the CPUs and memory of this host into a fixed number of slots, shared by all metro builds running
+	on it, so that concurrent builds don't each size MAKEOPTS for the whole machine. The slots in use are recorded in a
+	JSON file under path/tmp, which is only read and written while holding an exclusive lock on slots.lock. Slots held
+	by processes that no longer exist are reclaimed.
+	"""
+
+	def __init__(self, path, slots):
+		self.path = path
+		self.slots = slots
+		self.state_path = os.path.join(path, "slots.json")
+		self.lock_path = os.path.join(path, "slots.lock")
+
+	def share(self):
+		return {"cpus": max(host_nproc() // self.slots, 1), "mem": host_memory() // self.slots}
+
+	def update(self, fnc):
+		"""Call fnc with the slots in use, which it can modify, and return whatever it returns."""
+		os.makedirs(self.path, exist_ok=True)
+		# the lock file is opened read-only, and slots.json only rewritten if it changes, so that we don't wake up
+		# anyone waiting for a slot (see wait()) for no reason:
+		with open(os.open(self.lock_path, os.O_RDONLY | os.O_CREAT, 0o644), "r") as lockfile:
+			fcntl.flock(lockfile, fcntl.LOCK_EX)
+			try:
+				with open(self.state_path, "r") as inf:
+					orig_state = inf.read()
+				state = json.loads(orig_state)
+			except (IOError, ValueError):
+				orig_state = None
+				state = {}
+			for key in list(state.keys()):
+				try:
+					os.kill(state[key]["pid"], 0)
+				except ProcessLookupError:
+					del state[key]
+				except PermissionError:
+					pass
+			result = fnc(state)
+			new_state = json.dumps(state, indent=4)
+			if new_state != orig_state:
+				tmp_path = self.state_path + ".tmp"
+				with open(tmp_path, "w") as outf:
+					outf.write(new_state)
+				os.replace(tmp_path, self.state_path)
+		return result
+
+	def reserve(self, name):
+		"""Reserve a slot for name, and return a grant describing it, or None if all slots are in use."""
+		key = "%s/%s" % (os.getpid(), name)
+
+		def reserve_free(state):
+			used = [holder["slot"] for holder in state.values()]
+			for slot in range(self.slots):
+				if slot not in used:
+					state[key] = {"pid": os.getpid(), "name": name, "slot": slot, "since": time.time()}
+					grant = self.share()
+					grant.update({"key": key, "slot": slot})
+					return grant
+			return None
+
+		return self.update(reserve_free)
+
+	def wait(self, name, mesg, interrupted=None):
+		"""
+		Reserve a slot for name, waiting for one to become free if need be, and return the grant. If interrupted is
+		set, it is called every few seconds while we wait, and if it returns True, we raise KeyboardInterrupt.
+		"""
+		os.makedirs(self.path, exist_ok=True)
+		with DirWatcher(self.path) as watcher:
+			grant = self.reserve(name)
+			if grant is None:
+				mesg("All %s build slots on this host are in use -- waiting for one to become free..." % self.slots)
+				while grant is None:
+					if interrupted is not None and interrupted():
+						raise KeyboardInterrupt
+					# slots.json is rewritten when a slot is released. Builds that die don't release their slot, so
+					# re-check every minute regardless:
+					watcher.wait(60 if interrupted is None else 5)
+					grant = self.reserve(name)
+		mesg("Reserved build slot %s: %s CPUs, %s MB of memory." % (grant["slot"], grant["cpus"], grant["mem"] // (1 << 20)))
+		return grant
+
+	def release(self, grant):
+		self.update(lambda state: state.pop(grant["key"], None))
+
+
+class LogSink:
+
+	"""
+	LogSink writes a log to path from a background thread, so that whoever is logging never has to wait for the disk,
+	or for compression. Data passed to write() is queued, and written out in order. Whatever has been written is made
+	readable on disk at least every flush_interval seconds. If rotate is set, once that many bytes have been written to
+	the log, it is moved to path.1 (path.1 to path.2, and so on, keeping up to keep old logs) at the end of the next
+	line, and a new log is started. LogIndex reads the rotated logs along with the current one. LogSink writes the log
+	as-is -- subclasses compress it, by overriding the *_segment() methods and sync().
+	"""
+
+	suffix = ""
+
+	def __init__(self, path, uid=-1, gid=-1, flush_interval=5, rotate=None, keep=5):
+		self.base_path = path
+		self.path = path + self.suffix
+		self.uid = uid
+		self.gid = gid
+		self.flush_interval = flush_interval
+		self.rotate = rotate
+		self.keep = keep
+		self.outf = None
+		# bytes written to the current log, and whether any of them were written since the last sync():
+		self.written = 0
+		self.dirty = False
+		self.error = None
+		# the queue is bounded, so a command that outputs faster than we can write just ends up waiting for us:
+		self.queue = queue.Queue(maxsize=256)
+		self.start_segment()
+		self.thread = threading.Thread(target=self.writer, name="LogSink %s" % self.path, daemon=True)
+		self.thread.start()
+
+	def write(self, data):
+		self.queue.put(data)
+
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+
+	def open_file(self):
+		outf = open(self.path, "wb")
+		os.chown(self.path, self.uid, self.gid)
+		return outf
+
+	def start_segment(self):
+		self.outf = self.open_file()
+
+	def put(self, data):
+		self.outf.write(data)
+
+	def sync(self):
+		self.outf.flush()
+
+	def end_segment(self):
+		self.outf.close()
+
+	def segment_path(self, num):
+		return "%s.%s%s" % (self.base_path, num, self.suffix)
+
+	def rotate_log(self):
+		self.end_segment()
+		if os.path.exists(self.segment_path(self.keep)):
+			os.unlink(self.segment_path(self.keep))
+		for num in range(self.keep - 1, 0, -1):
+			if os.path.exists(self.segment_path(num)):
+				os.rename(self.segment_path(num), self.segment_path(num + 1))
+		os.rename(self.path, self.segment_path(1))
+		self.start_segment()
+		self.written = 0
+
+	def writer(self):
+		last_sync = time.monotonic()
+		while True:
+			try:
+				data = self.queue.get(timeout=max(last_sync + self.flush_interval - time.monotonic(), 0) if self.dirty else None)
+			except queue.Empty:
+				data = b""
+			if data is None:
+				# we're done, whether or not the log can be finished off:
+				try:
+					self.end_segment()
+				except (IOError, OSError) as e:
+					self.log_error(e)
+				break
+			if self.error is not None:
+				# we can't write the log, but keep on taking data off the queue, so nobody gets stuck waiting on it:
+				continue
+			try:
+				if data:
+					if self.rotate and self.written and self.written + len(data) > self.rotate:
+						# rotated logs end with a complete line, so LogIndex can index each of them on its own:
+						end = data.rfind(b"\n") + 1
+						if end:
+							self.put(data[:end])
+							self.rotate_log()
+							data = data[end:]
+					self.put(data)
+					self.written += len(data)
+					self.dirty = True
+				if self.dirty and time.monotonic() - last_sync >= self.flush_interval:
+					self.sync()
+					self.dirty = False
+					last_sync = time.monotonic()
+			except (IOError, OSError) as e:
+				self.log_error(e)
+
+	def log_error(self, e):
+		if self.error is None:
+			self.error = e
+			sys.stderr.write("Unable to write log %s: %s\n" % (self.path, e))
+		# there's nothing left to flush, so wait for more data (or close()) without a timeout:
+		self.dirty = False
+
+
+class PipeLogSink(LogSink):
+
+	"""
+	PipeLogSink compresses the log by piping it through a compressor, which runs until the log is closed or rotated.
+	sync() hands the compressor everything written so far; when it reaches the log is up to the compressor.
+	"""
+
+	command = None
+
+	def __init__(self, path, **kwargs):
+		if shutil.which(self.command[0]) is None:
+			raise MetroError("Can't compress log %s with %s -- %s not found." % (path, self.command[0], self.command[0]))
+		super().__init__(path, **kwargs)
+
+	def get_command(self):
+		return self.command
+
+	def start_segment(self):
+		self.outf = self.open_file()
+		self.proc = subprocess.Popen(self.get_command(), stdin=subprocess.PIPE, stdout=self.outf)
+
+	def put(self, data):
+		self.proc.stdin.write(data)
+
+	def sync(self):
+		self.proc.stdin.flush()
+
+	def end_segment(self):
+		try:
+			self.proc.stdin.close()
+		finally:
+			self.outf.close()
+			self.proc.wait()
+		if self.proc.returncode != 0:
+			raise IOError("%s exited with return code %s" % (self.command[0], self.proc.returncode))
+
+
+class XzLogSink(PipeLogSink):
+
+	"""
+	XzLogSink compresses the log with xz, which flushes what it has compressed so far to the log whenever no more has
+	arrived for flush_interval seconds.
+	"""
+
+	suffix = ".xz"
+	command = ["xz", "-q", "-T1", "-c"]
+	# compression has to keep up with the build, so we trade some size for speed:
+	preset = 1
+
+	def get_command(self):
+		return self.command + ["-%s" % self.preset, "--flush-timeout=%d" % max(self.flush_interval * 1000, 1)]
+
+
+class ZstdLogSink(PipeLogSink):
+
+	"""
+	ZstdLogSink compresses the log with zstd. zstd can't be told to flush, so the log on disk lags behind by whatever
+	zstd has buffered -- use XzLogSink if logs need to be followed while they're written.
+	"""
+
+	suffix = ".zst"
+	command = ["zstd", "-q", "-c"]
+
+
+class EventLog:
+
+	"""
+	EventLog records what happens while building a target -- metro's messages, the commands it runs, and how they exit --
+	as JSON, one event per line, so that tools don't have to pick them out of the log.
+	"""
+
+	def __init__(self, path, uid=-1, gid=-1):
+		self.path = path
+		self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+		os.chown(path, uid, gid)
+
+	def event(self, event, **fields):
+		record = {"time": time.time(), "event": event}
+		record.update(fields)
+		os.write(self.fd, (json.dumps(record) + "\n").encode("utf-8"))
+
+	def close(self):
+		os.close(self.fd)
+
+
+class LogScanner:
+
+	"""
+	LogScanner picks the lines we care about out of a build's output while it is being written to the log, so that when
+	a build fails, we already know which ebuilds failed and where their build logs are, without searching the log.
+	"""
+
+	line_re = re.compile(rb" \* (?:ERROR: (.*) failed \((.*) phase\)|The complete build log is located at (.*))")
+	emerging_re = re.compile(rb">>> Emerging (?:binary )?\((\d+) of (\d+)\) (\S+)")
+	# the unfinished last line of what we've been fed is kept until the rest of it arrives, up to this many bytes:
+	max_line = 65536
+
+	def __init__(self):
+		self.partial = b""
+		# (ebuild, phase) of each failed ebuild:
+		self.errors = set()
+		# path of the most recent "complete build log", as printed by emerge:
+		self.build_log = None
+		# (N, M, package) from the most recent ">>> Emerging (N of M) package" line:
+		self.emerging = None
+
+	def feed(self, data):
+		data = self.partial + data
+		end = data.rfind(b"\n") + 1
+		self.partial = data[end:end + self.max_line]
+		self.scan(data[:end])
+
+	def close(self):
+		self.scan(self.partial)
+		self.partial = b""
+
+	def scan(self, data):
+		# only lines starting with " * " can match, and find() is a lot quicker at finding them than a regex is:
+		data = b"\n" + data
+		pos = data.rfind(b"\n>>> Emerging ")
+		if pos != -1:
+			match = self.emerging_re.match(data, pos + 1)
+			if match is not None:
+				self.emerging = (int(match.group(1)), int(match.group(2)), match.group(3).decode("utf-8", "replace"))
+		pos = data.find(b"\n * ")
+		while pos != -1:
+			match = self.line_re.match(data, pos + 1)
+			pos = data.find(b"\n * ", pos + 1)
+			if match is None:
+				continue
+			if match.group(3) is not None:
+				self.build_log = match.group(3).decode("utf-8", "replace")
+				continue
+			ebuild = match.group(1).decode("utf-8", "replace")
+			phase = match.group(2).decode("utf-8", "replace")
+			if len(ebuild.split()) == 1 and len(ebuild.split("/")) == 2 and len(phase.split()) == 1:
+				self.errors.add((ebuild, phase))
+
 
 class CommandRunner:
 
 	"""CommandRunner is a class that allows commands to run, and messages to be displayed. By default, output will go to a log file.
-	Messages will appear on stdout and in the logs."""
+	Messages will appear on stdout and in the logs. The log is written by a LogSink, chosen by log/compression, and what
+	happens is also recorded as JSON in <target>.events.jsonl, by an EventLog."""
+
+	log_sinks = {
+		"none": LogSink,
+		"xz": XzLogSink,
+		"zstd": ZstdLogSink
+	}
+	# CommandRunners that haven't been closed yet -- see interrupt_all():
+	active = set()
+	active_lock = threading.Lock()
 
 	def __init__(self, settings: Collection = None, logging=True):
 		self.settings = settings
 		self.logging = logging
+		self.sink = None
+		self.events = None
+		# set by interrupt(). self.cmd is the command we're running, until it has exited:
+		self.interrupted = False
+		self.cmd = None
+		self.cmd_lock = threading.Lock()
+		with CommandRunner.active_lock:
+			CommandRunner.active.add(self)
+		# everything logged by the commands we run is scanned for failed ebuilds as it is written -- see tee_output():
+		self.scanner = LogScanner()
 		if self.settings and self.logging:
 			self.fname = self.settings["path/mirror/target/path"] + "/log/" + self.settings["target"] + ".txt"
 			if not os.path.exists(os.path.dirname(self.fname)):
@@ -103,29 +748,77 @@ class CommandRunner:
 					self.settings["path/mirror/dirmode"], "-d", os.path.dirname(self.fname)], {}
 				)
 				self.logging = True
-			self.cmdout = open(self.fname, "w+")
-			# set logfile ownership:
-			os.chown(self.fname, pwd.getpwnam(self.settings["path/mirror/owner"]).pw_uid, grp.getgrnam(self.settings["path/mirror/group"]).gr_gid)
-			sys.stdout.write("Logging output to %s.\n" % self.fname)
+			uid = pwd.getpwnam(self.settings["path/mirror/owner"]).pw_uid
+			gid = grp.getgrnam(self.settings["path/mirror/group"]).gr_gid
+			compression = self.get_setting("log/compression", "none")
+			if compression not in self.log_sinks:
+				raise MetroError("log/compression must be one of: %s" % " ".join(self.log_sinks))
+			self.sink = self.log_sinks[compression](
+				self.fname,
+				uid=uid,
+				gid=gid,
+				flush_interval=float(self.get_setting("log/flush", "5")),
+				rotate=parse_size(self.get_setting("log/rotate", None)),
+				keep=int(self.get_setting("log/keep", "5"))
+			)
+			self.events = EventLog(self.fname[:-len(".txt")] + ".events.jsonl", uid=uid, gid=gid)
+			sys.stdout.write("Logging output to %s.\n" % self.sink.path)
+			# per-phase timings of this target (see run()) are recorded in timings.json, next to our log. Forget
+			# about any earlier runs:
+			self.timings_fname = os.path.join(os.path.dirname(self.fname), "timings.json")
+			self.update_timings(lambda timings: timings.pop(self.settings["target"], None))
+			# emerge progress is published here while commands run -- see update_progress():
+			self.progress_fname = os.path.join(self.settings["path/mirror/target/control"], "progress", self.settings["target"] + ".json")
+			self.progress = None
+			self.expected = {}
+			if os.path.exists(self.progress_fname):
+				os.unlink(self.progress_fname)
+
+	def get_setting(self, key, default):
+		return self.settings[key] if key in self.settings else default
 
 	def mesg(self, msg):
 		if self.logging:
-			self.cmdout.write(msg + "\n")
-			self.cmdout.flush()
+			self.sink.write((msg + "\n").encode("utf-8"))
+			self.events.event("mesg", text=msg)
 		sys.stdout.write(msg + "\n")
 
+	def close(self):
+		"""Finish writing our log. Nothing more can be logged after this."""
+		with CommandRunner.active_lock:
+			CommandRunner.active.discard(self)
+		if self.sink is not None:
+			self.sink.close()
+			self.events.close()
+			self.sink = self.events = None
+		self.logging = False
+
+	def interrupt(self):
+		"""
+		Stop the command we're running, and make run() raise KeyboardInterrupt from now on, as if ctrl-C had been hit.
+		ctrl-C only interrupts the main thread, and commands only get it if it came from the terminal, so metro calls
+		this (through interrupt_all()) for targets being built in other threads.
+		"""
+		with self.cmd_lock:
+			self.interrupted = True
+			if self.cmd is not None:
+				# it may have exited, but it hasn't been reaped, so its pid is still its own:
+				os.kill(self.cmd.pid, signal.SIGTERM)
+
+	@classmethod
+	def interrupt_all(cls):
+		with cls.active_lock:
+			runners = list(cls.active)
+		for runner in runners:
+			runner.interrupt()
+
 	def extract_build_log_path(self):
 		"""
-		Scan metro build log and extract the full path to the build.log of the failed package.
+		Copy the build.log of the failed package, found by our LogScanner, to our log directory.
 		"""
-		prefix = " * The complete build log is located at "
-		s, out = subprocess.getstatusoutput(
-			f'tac {self.fname} | grep -m 1 -E "^ \\* The complete build log is located at"'
-		)
-		if s != 0:
-			raise SystemError("Couldn't run tac on build log.")
-		line = out.strip()
-		line = line[len(prefix):]
+		if self.scanner.build_log is None:
+			return
+		line = self.scanner.build_log.strip()
 		if line.endswith("."):
 			line = line[:-1]
 		line = line.strip("'")
@@ -136,49 +829,195 @@ class CommandRunner:
 
 	def extract_build_log_catpkg(self):
 		"""
-		Scan metro build log and extract the actual package the failed, along with associated metadata.
+		Write the packages that failed, found by our LogScanner, along with the phase they failed in, to errors.json.
 		"""
-		s, out = subprocess.getstatusoutput(
-			f'cat {self.fname} | grep "^ \\* ERROR: " | sort -u | sed -e \'s/^ \\* ERROR: \\(.*\\) failed (\\(.*\\) phase).*/\\1 \\2/g\'')
-		if s == 0:
-			errors = []
-			for line in out.split('\n'):
-				parts = line.split()
-				if len(parts) != 2:
-					# not what we're looking for
-					continue
-				if len(parts[0].split("/")) != 2:
-					continue
-				errors.append({"ebuild": parts[0], "phase": parts[1]})
-			if len(errors):
-				fname = os.path.join(self.settings["path/mirror/target/path"], "log/errors.json")
-				self.mesg("Detected failed ebuilds... writing to %s." % fname)
-				a = open(fname, "w")
-				a.write(json.dumps(errors, indent=4))
-				a.close()
+		errors = [{"ebuild": ebuild, "phase": phase} for ebuild, phase in sorted(self.scanner.errors)]
+		self.events.event("failed-ebuilds", errors=errors, build_log=self.scanner.build_log)
+		if len(errors):
+			fname = os.path.join(self.settings["path/mirror/target/path"], "log/errors.json")
+			self.mesg("Detected failed ebuilds... writing to %s." % fname)
+			a = open(fname, "w")
+			a.write(json.dumps(errors, indent=4))
+			a.close()
 
 	def do_error_scan(self):
-		# scan log for errors -- and extract them!
+		# extract failed ebuild information found while the log was being written:
 		self.mesg("Attempting to extract failed ebuild information...")
-		if self.cmdout:
-			self.cmdout.flush()
 		self.extract_build_log_catpkg()
 		self.extract_build_log_path()
 
-	def run(self, cmdargs, env, error_scan=False):
+	def update_timings(self, fnc):
+		"""Call fnc with the contents of timings.json, which it can modify, while holding a lock on it."""
+		with open(os.open(self.timings_fname, os.O_RDWR | os.O_CREAT, 0o644), "r+") as tfile:
+			fcntl.flock(tfile, fcntl.LOCK_EX)
+			try:
+				timings = json.loads(tfile.read() or "{}")
+			except ValueError:
+				timings = {}
+			fnc(timings)
+			tfile.seek(0)
+			tfile.truncate()
+			tfile.write(json.dumps(timings, indent=4))
+			os.chown(self.timings_fname, pwd.getpwnam(self.settings["path/mirror/owner"]).pw_uid, grp.getgrnam(self.settings["path/mirror/group"]).gr_gid)
+
+	@staticmethod
+	def wait_with_usage(cmd):
+		"""
+		Wait for cmd (a Popen object) to exit, and return its exit code, along with the resources used by it and the
+		processes it waited for. I/O counters are read from /proc/<pid>/io after the process exits, but before it is
+		reaped, since they go away when it is.
+		"""
+		io = {}
+		os.waitid(os.P_PID, cmd.pid, os.WEXITED | os.WNOWAIT)
+		try:
+			with open("/proc/%s/io" % cmd.pid, "r") as iofile:
+				for line in iofile:
+					key, value = line.split(":")
+					io[key] = int(value)
+		except (IOError, ValueError):
+			pass
+		pid, status, rusage = os.wait4(cmd.pid, 0)
+		cmd.returncode = os.waitstatus_to_exitcode(status)
+		usage = {
+			"user": rusage.ru_utime,
+			"sys": rusage.ru_stime,
+			"maxrss_kb": rusage.ru_maxrss,
+			"read_bytes": io.get("read_bytes"),
+			"write_bytes": io.get("write_bytes"),
+			"rchar": io.get("rchar"),
+			"wchar": io.get("wchar")
+		}
+		return cmd.returncode, usage
+
+	def expected_duration(self, phase):
+		"""
+		Return how long phase usually takes for our target, on this subarch: the median wall time of the last five
+		successful builds in the performance history, or None if we don't know.
+		"""
+		if phase not in self.expected:
+			durations = []
+			match = {"target": self.settings["target"], "status": "ok"}
+			for key, setting in [("release", "target/build"), ("arch", "target/arch_desc"), ("subarch", "target/subarch")]:
+				match[key] = self.get_setting(setting, None)
+			for record in perf_history(self.settings).records():
+				if all(record.get(key) == value for key, value in match.items()) and phase in (record.get("phases") or {}):
+					durations.append(record["phases"][phase])
+			self.expected[phase] = statistics.median(durations[-5:]) if durations else None
+		return self.expected[phase]
+
+	def update_progress(self, phase, start, exitcode=None):
+		"""
+		Publish how far the emerge running in phase has got to progress_fname, for schedulers and dashboards. The ETA
+		is when phase usually finishes, going by earlier builds, or once that has passed (or if there are no earlier
+		builds), is estimated from how fast packages have been emerged so far.
+		"""
+		now = time.time()
+		num, total, package = self.scanner.emerging
+		if self.progress is None or self.progress["phase"] != phase or num < self.progress["num"]:
+			# a new emerge has started:
+			self.progress = {"target": self.settings["target"], "phase": phase, "phase_start": start, "emerge_start": now}
+		rate = None
+		if num > 1 and now > self.progress["emerge_start"]:
+			rate = (num - 1) * 60 / (now - self.progress["emerge_start"])
+		eta = eta_source = None
+		expected = self.expected_duration(phase)
+		if expected is not None and now < start + expected:
+			eta, eta_source = start + expected, "history"
+		elif rate:
+			eta, eta_source = now + (total - num + 1) * 60 / rate, "rate"
+		self.progress.update({
+			"num": num,
+			"of": total,
+			"package": package,
+			"packages_per_minute": rate,
+			"eta": eta,
+			"eta_source": eta_source,
+			"updated": now,
+			"exitcode": exitcode
+		})
+		os.makedirs(os.path.dirname(self.progress_fname), exist_ok=True)
+		tmp_fname = "%s.%s.tmp" % (self.progress_fname, os.getpid())
+		with open(tmp_fname, "w") as outf:
+			outf.write(json.dumps(self.progress, indent=4))
+		os.chown(tmp_fname, pwd.getpwnam(self.settings["path/mirror/owner"]).pw_uid, grp.getgrnam(self.settings["path/mirror/group"]).gr_gid)
+		os.replace(tmp_fname, self.progress_fname)
+
+	def tee_output(self, cmd, phase=None, start=None):
+		"""
+		Copy the output of cmd to our log sink, and feed it to our LogScanner, until cmd exits. Once it has, anything still
+		waiting to be read from the pipe (from processes cmd left running, say) is copied too, and then we stop. Whenever
+		a new package starts being emerged, our progress is updated.
+		"""
+		fd = cmd.stdout.fileno()
+		exited = False
+		try:
+			while True:
+				ready, _, _ = select.select([fd], [], [], 0 if exited else 0.5)
+				if not ready:
+					if exited:
+						break
+					# find out whether cmd has exited, without reaping it -- wait_with_usage() does that:
+					exited = os.waitid(os.P_PID, cmd.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+					continue
+				chunk = os.read(fd, 65536)
+				if not chunk:
+					break
+				self.sink.write(chunk)
+				emerging = self.scanner.emerging
+				self.scanner.feed(chunk)
+				if self.scanner.emerging != emerging:
+					self.update_progress(phase, start)
+		finally:
+			cmd.stdout.close()
+			self.scanner.close()
+
+	def run(self, cmdargs, env, error_scan=False, phase=None):
+		"""
+		Run cmdargs, returning its exit code. If phase is set (run_script() uses the name of the step), the wall time
+		and resources used by the command are recorded under that name in timings.json.
+		"""
 		self.mesg("Running command: %s (env %s) " % (cmdargs, env))
 		cmd = None
 		try:
+			if self.interrupted:
+				raise KeyboardInterrupt
+			start = time.time()
 			if self.logging:
-				cmd = subprocess.Popen(cmdargs, env=env, stdout=self.cmdout, stderr=subprocess.STDOUT)
+				self.events.event("command", cmd=cmdargs, phase=phase)
+				cmd = subprocess.Popen(cmdargs, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 			else:
 				cmd = subprocess.Popen(cmdargs, env=env)
-			exitcode = cmd.wait()
+			with self.cmd_lock:
+				self.cmd = cmd
+				if self.interrupted:
+					os.kill(cmd.pid, signal.SIGTERM)
+			if self.logging:
+				self.tee_output(cmd, phase, start)
+			# interrupt() mustn't signal cmd once it has been reaped, and its pid could be reused:
+			os.waitid(os.P_PID, cmd.pid, os.WEXITED | os.WNOWAIT)
+			with self.cmd_lock:
+				self.cmd = None
+			exitcode, usage = self.wait_with_usage(cmd)
+			if self.interrupted:
+				raise KeyboardInterrupt
 		except KeyboardInterrupt:
-			cmd.terminate()
+			with self.cmd_lock:
+				self.cmd = None
+			if cmd is not None and cmd.returncode is None:
+				cmd.terminate()
 			self.mesg("Interrupted via keyboard!")
 			raise
 		else:
+			if self.logging:
+				self.events.event("exit", cmd=cmdargs, phase=phase, exitcode=exitcode, wall=time.time() - start)
+				if self.scanner.emerging is not None:
+					# this command emerged packages, so record how it went:
+					self.update_progress(phase, start, exitcode)
+					self.scanner.emerging = self.progress = None
+			if phase is not None and self.logging:
+				timing = {"phase": phase, "start": start, "wall": time.time() - start, "exitcode": exitcode}
+				timing.update(usage)
+				self.update_timings(lambda timings: timings.setdefault(self.settings["target"], []).append(timing))
 			if exitcode != 0:
 				self.mesg("Command exited with return code %s" % exitcode)
 				if error_scan and self.logging:
@@ -186,6 +1025,309 @@ class CommandRunner:
 			return exitcode
 
 
+class PerfHistory:
+
+	"""
+	PerfHistory is an append-only store of build performance records -- duration, artifact size, phase timings and so
+	on, for each target built. Records are stored one JSON object per line, and each is appended with a single write(),
+	so builds running at the same time don't get in each other's way.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+
+	def append(self, record):
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+		try:
+			os.write(fd, (json.dumps(record, sort_keys=True) + "\n").encode("utf-8"))
+		finally:
+			os.close(fd)
+
+	def records(self):
+		try:
+			inf = open(self.path, "r")
+		except FileNotFoundError:
+			return
+		with inf:
+			for line in inf:
+				try:
+					yield json.loads(line)
+				except ValueError:
+					# a partially-written record, from a build that crashed:
+					continue
+
+
+class Profiles:
+
+	"""
+	Profiles collects cProfile profiles of metro, for --profile. cProfile only profiles the thread it is started in, so
+	work done in each thread is run through profiled(). Since Python 3.12, only one profiler can be active in a
+	process at a time, so a thread that waits for other threads to do the work pauses its profiler (see paused()), and
+	if several threads want to be profiled at once, only the first is -- the rest run unprofiled, and are counted in
+	self.unprofiled.
+	"""
+
+	def __init__(self):
+		self.profiles = []
+		self.unprofiled = 0
+		self.lock = threading.Lock()
+		# the profiler of the current thread, if it has one:
+		self.local = threading.local()
+
+	def profiled(self, fnc, *args):
+		"""Call fnc(*args), and return its result, profiling it if we can."""
+		profiler = cProfile.Profile()
+		with self.lock:
+			try:
+				profiler.enable()
+			except ValueError:
+				# another thread is being profiled:
+				self.unprofiled += 1
+				profiler = None
+			else:
+				self.profiles.append(profiler)
+		if profiler is None:
+			return fnc(*args)
+		self.local.profiler = profiler
+		try:
+			return fnc(*args)
+		finally:
+			profiler.disable()
+			self.local.profiler = None
+
+	@contextlib.contextmanager
+	def paused(self):
+		"""Pause the current thread's profiler, if it has one, so that other threads can be profiled."""
+		profiler = getattr(self.local, "profiler", None)
+		if profiler is not None:
+			profiler.disable()
+		try:
+			yield
+		finally:
+			if profiler is not None:
+				profiler.enable()
+
+
+class LogIndex:
+
+	"""
+	LogIndex records where the interesting parts of a target's log are -- the start of each step run by run_script(),
+	each package emerged, failed ebuilds, and commands that failed -- so that failures can be found without reading
+	through whole logs. The index is kept next to the log, in .<log>.index.json, and update() only scans what has been
+	added to the log since it was last indexed. Uncompressed logs are scanned using mmap, so they're never read into
+	memory. Compressed logs (see LogSink) are decompressed while they're scanned, and re-scanned if they change. A log
+	that has been rotated is read as if the logs it was rotated to, oldest first, came before it. Offsets are always
+	into the uncompressed log.
+	"""
+
+	version = 2
+	line_re = re.compile(
+		rb"(?:run_script: running (\S+)\.\.\.|>>> (Emerging|Completed)(?: binary)? \((\d+) of (\d+)\) (\S+)|"
+		rb" \* ERROR: (\S+) failed \((\S+) phase\)|Command exited with return code (-?\d+))"
+	)
+	# the same, for the lines after the first -- a regex that starts with a newline is far quicker to search with:
+	marker_re = re.compile(b"\n" + line_re.pattern)
+	chunk_size = 1 << 20
+
+	def __init__(self, log_path):
+		self.log_path = log_path
+		self.index_path = os.path.join(os.path.dirname(log_path), "." + os.path.basename(log_path) + ".index.json")
+		self.compressed = log_path.endswith((".xz", ".zst"))
+
+	@classmethod
+	def empty(cls):
+		return {
+			"version": cls.version,
+			"file": None,
+			"offset": 0,
+			"phases": [],
+			"packages": [],
+			"errors": [],
+			"exits": []
+		}
+
+	def load(self):
+		try:
+			with open(self.index_path, "r") as inf:
+				data = json.load(inf)
+		except (IOError, ValueError):
+			return self.empty()
+		return data if data.get("version") == self.version else self.empty()
+
+	def save(self, data):
+		tmp_path = "%s.%s.tmp" % (self.index_path, os.getpid())
+		with open(tmp_path, "w") as outf:
+			json.dump(data, outf)
+		os.replace(tmp_path, self.index_path)
+
+	def segments(self):
+		"""Return the paths the log is made up of: the logs it was rotated to (see LogSink), oldest first, and itself."""
+		base, suffix = self.log_path, ""
+		if self.compressed:
+			base, suffix = os.path.splitext(self.log_path)
+		prefix = os.path.basename(base) + "."
+		rotated = []
+		for filename in os.listdir(os.path.dirname(base) or "."):
+			if filename.startswith(prefix) and filename.endswith(suffix):
+				num = filename[len(prefix):len(filename) - len(suffix)]
+				if num.isdigit():
+					rotated.append((int(num), os.path.join(os.path.dirname(base), filename)))
+		return [path for num, path in sorted(rotated, reverse=True)] + [self.log_path]
+
+	def update(self):
+		"""Bring the index up-to-date with the log, and return it."""
+		segments = self.segments()
+		stats = [os.stat(path) for path in segments]
+		data = self.load()
+		if self.compressed:
+			file_info = [{"size": st.st_size, "mtime": st.st_mtime_ns} for st in stats]
+			if data["file"] == file_info:
+				return data
+			data = self.empty()
+			pending = b""
+			for chunk in self.chunks():
+				buf = pending + chunk
+				end = buf.rfind(b"\n") + 1
+				self.scan(data, buf, 0, end, data["offset"])
+				pending = buf[end:]
+				data["offset"] += end
+		else:
+			# logs are only ever appended to, unless they're replaced (when rotated, or re-built):
+			file_info = [{"dev": st.st_dev, "ino": st.st_ino} for st in stats]
+			size = sum(st.st_size for st in stats)
+			if data["file"] != file_info or size < data["offset"]:
+				data = self.empty()
+			elif size == data["offset"]:
+				return data
+			seg_start = 0
+			for path, st in zip(segments, stats):
+				if data["offset"] < seg_start + st.st_size:
+					with open(path, "rb") as inf, mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+						start = data["offset"] - seg_start
+						if path == self.log_path:
+							# only complete lines are indexed -- the rest is picked up next time:
+							end = buf.rfind(b"\n", start) + 1
+						else:
+							# rotated logs end with a complete line:
+							end = st.st_size
+						if end > start:
+							self.scan(data, buf, start, end, seg_start)
+							data["offset"] = seg_start + end
+				seg_start += st.st_size
+		data["file"] = file_info
+		self.save(data)
+		return data
+
+	def chunks(self):
+		"""Yield the contents of the uncompressed log, a chunk at a time."""
+		for path in self.segments():
+			if path.endswith(".zst"):
+				# zstd complains about logs that are still being written, which we expect:
+				proc = subprocess.Popen(["zstd", "-dcq", path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+				try:
+					yield from iter(lambda: proc.stdout.read(self.chunk_size), b"")
+				finally:
+					proc.stdout.close()
+					proc.wait()
+			elif path.endswith(".xz"):
+				# the log may still be being written, so its xz stream may not be finished -- decompress what's there:
+				decompressor = lzma.LZMADecompressor()
+				with open(path, "rb") as inf:
+					for data in iter(lambda: inf.read(self.chunk_size), b""):
+						while data:
+							if decompressor.eof:
+								decompressor = lzma.LZMADecompressor()
+							chunk = decompressor.decompress(data)
+							data = decompressor.unused_data if decompressor.eof else b""
+							if chunk:
+								yield chunk
+			else:
+				with open(path, "rb") as inf:
+					yield from iter(lambda: inf.read(self.chunk_size), b"")
+
+	def read(self, start, end=None):
+		"""Yield the part of the log from offset start to end (or the end of the log), a chunk at a time."""
+		if not self.compressed:
+			seg_start = 0
+			for path in self.segments():
+				with open(path, "rb") as inf:
+					seg_end = seg_start + os.fstat(inf.fileno()).st_size
+					if seg_end > start or path == self.log_path:
+						inf.seek(max(start - seg_start, 0))
+						while end is None or seg_start + inf.tell() < end:
+							chunk = inf.read(self.chunk_size if end is None else min(self.chunk_size, end - seg_start - inf.tell()))
+							if not chunk:
+								break
+							yield chunk
+				seg_start = seg_end
+				if end is not None and seg_start >= end:
+					break
+			return
+		# compressed logs can't be seeked in, so we have to decompress everything up to start:
+		pos = 0
+		for chunk in self.chunks():
+			if end is not None and pos >= end:
+				break
+			if pos + len(chunk) > start:
+				yield chunk[max(start - pos, 0):None if end is None else end - pos]
+			pos += len(chunk)
+
+	def scan(self, data, buf, start, end, base):
+		# index the complete lines in buf[start:end]. buf[start] is the start of a line, at offset base + start.
+		matches = self.marker_re.finditer(buf, start, end)
+		first = self.line_re.match(buf, start, end)
+		if first is not None:
+			matches = itertools.chain([first], matches)
+		for match in matches:
+			offset = base + match.start() + (0 if match is first else 1)
+			phase, action, num, total, package, ebuild, ebuild_phase, exitcode = [
+				group.decode("utf-8", "replace") if group is not None else None for group in match.groups()
+			]
+			if phase is not None:
+				data["phases"].append({"phase": phase, "offset": offset})
+			elif action == "Emerging":
+				data["packages"].append({"package": package, "num": int(num), "of": int(total), "start": offset, "end": None})
+			elif action == "Completed":
+				for record in reversed(data["packages"]):
+					if record["package"] == package and record["end"] is None:
+						record["end"] = offset
+						break
+			elif ebuild is not None:
+				data["errors"].append({"ebuild": ebuild, "phase": ebuild_phase, "offset": offset})
+			elif exitcode != "0":
+				data["exits"].append({"exitcode": int(exitcode), "offset": offset})
+
+	@staticmethod
+	def failure(data):
+		"""
+		Return where the first failed command in the log (as indexed in data) failed: a dict with the "phase" it was
+		running in, the "package" being emerged, if any, and the "errors" (failed ebuilds) logged during that phase.
+		Return None if no command failed.
+		"""
+		if not data["exits"]:
+			return None
+		failed_at = data["exits"][0]["offset"]
+		phase = None
+		for record in data["phases"]:
+			if record["offset"] > failed_at:
+				break
+			phase = record
+		package = None
+		for record in data["packages"]:
+			if record["start"] > failed_at:
+				break
+			if record["end"] is None and (phase is None or record["start"] > phase["offset"]):
+				package = record
+		errors = [record for record in data["errors"] if (phase is None or record["offset"] > phase["offset"]) and record["offset"] < failed_at]
+		return {"phase": phase, "package": package, "errors": errors, "offset": failed_at}
+
+
+def perf_history(settings):
+	"""Return the PerfHistory that builds in the mirror are recorded in."""
+	return PerfHistory(os.path.join(settings["path/mirror"], ".perf", "history.jsonl"))
+
+
 class StampFile:
 
 	def __init__(self, path):
@@ -211,15 +1353,22 @@ class StampFile:
 		except FileNotFoundError:
 			pass
 
-	def wait(self, seconds):
-		elapsed = 0
-		while os.path.exists(self.path) and elapsed < seconds:
-			sys.stderr.write(".")
-			sys.stderr.flush()
-			time.sleep(5)
-			elapsed += 5
-		if os.path.exists(self.path):
-			return False
+	def wait(self, seconds, interrupted=None):
+		"""
+		Wait up to seconds for our file to go away, returning False if it is still there. If interrupted is set, it is
+		called every few seconds while we wait, and if it returns True, we raise KeyboardInterrupt.
+		"""
+		deadline = time.monotonic() + seconds
+		with DirWatcher(os.path.dirname(self.path)) as watcher:
+			while self.exists():
+				if interrupted is not None and interrupted():
+					raise KeyboardInterrupt
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return False
+				# we're woken up as soon as the file is removed, but re-check every minute anyway, since we aren't told
+				# about files removed by other hosts, or about the process holding a lock dying:
+				watcher.wait(min(remaining, 60 if interrupted is None else 5))
 		return True
 
 	def gen_file_contents(self):
@@ -228,11 +1377,19 @@ class StampFile:
 
 class LockFile(StampFile):
 
-	"""Class to create lock files; used for tracking in-progress metro builds."""
+	"""
+	Class to create lock files; used for tracking in-progress metro builds. The process that creates a lock file holds
+	an flock() on it for as long as the lock is held, so the kernel releases it if the process dies. The file contains
+	the hostname and pid of its creator. flock() doesn't work across hosts on NFS, and older versions of metro don't
+	flock() their lock files at all, so a lock file that isn't flock()ed is only stale if it was created on this host,
+	by a process that no longer exists -- see _stale().
+	"""
 
 	def __init__(self, path):
 		super().__init__(path)
-		self.hostname = subprocess.getoutput("/bin/hostname")
+		self.hostname = host_name()
+		# our open, flock()ed lock file, if we hold the lock:
+		self.fd = None
 
 	def _from_file(self):
 		data = self.get()
@@ -264,10 +1421,7 @@ class LockFile(StampFile):
 
 	@property
 	def created_by_me(self) -> bool:
-		if self.hostname_from_file == self.hostname and self.pid_from_file == os.getpid():
-			return True
-		else:
-			return False
+		return self.fd is not None
 
 	@property
 	def pid_exists(self) -> bool:
@@ -281,48 +1435,137 @@ class LockFile(StampFile):
 		return False
 
 	def create(self):
-		if self.exists():
+		if self.fd is not None or self.exists():
+			return False
+		# The lock file is written and flock()ed under a temporary name, and then hard-linked into place, which fails if
+		# the lock file already exists. So, the lock file never exists without being locked, and only one process can
+		# create it:
+		tmp_path = "%s.%s.%s.%s" % (self.path, self.hostname, os.getpid(), threading.get_ident())
+		try:
+			fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+		except OSError:
 			return False
 		try:
-			out = open(self.path, "w")
-		except IOError:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			os.write(fd, self.gen_file_contents().encode("utf-8"))
+			os.link(tmp_path, self.path)
+		except OSError:
+			os.close(fd)
 			return False
-		out.write(self.gen_file_contents())
-		out.close()
+		finally:
+			os.unlink(tmp_path)
+		self.fd = fd
 		self._created = True
 		return True
 
+	def info(self):
+		"""
+		Inspect the lock file without changing anything, even if it is stale. Return None if it doesn't exist, or a dict
+		with the "hostname" and "pid" that created it (None if unknown), and whether it is "held" by a process.
+		"""
+		try:
+			fd = os.open(self.path, os.O_RDONLY)
+		except FileNotFoundError:
+			return None
+		try:
+			data = os.read(fd, 4096).decode("utf-8", "replace")
+			if self.fd is not None:
+				held = True
+			else:
+				# a shared lock doesn't get in the way of anyone else inspecting the lock file at the same time:
+				try:
+					fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+					held = not self._stale(data)
+				except BlockingIOError:
+					held = True
+		finally:
+			os.close(fd)
+		info = {"hostname": None, "pid": None, "held": held}
+		data = data.split(":")
+		if len(data) == 2 and data[1].isdigit():
+			info["hostname"] = data[0]
+			info["pid"] = int(data[1])
+		return info
+
+	def _stale(self, data):
+		"""
+		Return True if data, the contents of a lock file that isn't flock()ed, shows that it is stale: it was created
+		on this host, by a process that no longer exists. Lock files from other hosts are never stale.
+		"""
+		data = data.split(":")
+		if len(data) != 2 or not data[1].isdigit() or data[0] != self.hostname:
+			return False
+		try:
+			os.kill(int(data[1]), 0)
+		except ProcessLookupError:
+			return True
+		except OSError:
+			# it exists, but belongs to someone else
+			pass
+		return False
+
+	def _probe(self):
+		"""
+		Probe the lock file, returning True if it exists and is flock()ed by a process (possibly us), or False if it
+		doesn't exist. If it isn't flock()ed, we return the open, flock()ed file, which the caller must close.
+		"""
+		if self.fd is not None:
+			return True
+		try:
+			fd = os.open(self.path, os.O_RDONLY)
+		except FileNotFoundError:
+			return False
+		try:
+			fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			os.close(fd)
+			return True
+		except OSError:
+			os.close(fd)
+			raise
+		return fd
+
 	def exists(self):
-		if os.path.exists(self.path):
-			if not self.created_by_this_host:
+		locked = self._probe()
+		if locked is True:
+			if not self.created_by_me and not self.created_by_this_host:
 				sys.stderr.write("# Currently locked by %s, pid %s\n" % (self.hostname_from_file, self.pid_from_file))
+			return True
+		elif locked is False:
+			return False
+		try:
+			if not self._stale(os.read(locked, 4096).decode("utf-8", "replace")):
+				# created by another host, or by an older metro that doesn't flock() -- and still running:
+				if not self.created_by_this_host:
+					sys.stderr.write("# Currently locked by %s, pid %s\n" % (self.hostname_from_file, self.pid_from_file))
 				return True
-			elif not self.pid_exists:
+			# we hold the flock of a stale lock file. Make sure it's still the one at our path before removing it:
+			st = os.stat(self.path)
+			lst = os.fstat(locked)
+			if (st.st_dev, st.st_ino) == (lst.st_dev, lst.st_ino):
 				sys.stderr.write("# Removing stale lock file: %s\n" % self.path)
 				self._unlink()
-				return False
-			else:
-				return True
-		else:
-			return False
+		except FileNotFoundError:
+			pass
+		finally:
+			os.close(locked)
+		return self.exists()
 
 	def _unlink(self):
 		super().unlink()
 
 	def unlink(self, force=False):
-		"""only unlink if *we* (hostname, pid) created the file. Otherwise, leave alone."""
-		do_unlink = False
-		if os.path.exists(self.path):
-			if not self.created_by_this_host:
-				if force is False:
-					sys.stderr.write("Won't unlink pidfile -- it was created by host %s!\n" % self.hostname_from_file)
-				else:
-					do_unlink = True
-			elif self.created_by_me:
-				# not only from this host, but our pid created it. So we own it, and can remove it.
-				do_unlink = True
-		if do_unlink:
+		"""only unlink if *we* hold the lock. Otherwise, leave alone, unless force is True."""
+		if self.fd is not None:
 			super().unlink()
+			# removing the file before releasing the lock means nobody can mistake it for a stale lock:
+			os.close(self.fd)
+			self.fd = None
+		elif os.path.exists(self.path):
+			if force is True:
+				super().unlink()
+			elif not self.created_by_this_host:
+				sys.stderr.write("Won't unlink pidfile -- it was created by host %s!\n" % self.hostname_from_file)
 
 	def gen_file_contents(self):
 		mypid = os.getpid()
@@ -1,4 +1,4 @@
-import os, sys, types
+import os, sys, threading, types
 from glob import glob
 from shutil import which
 
@@ -6,7 +6,6 @@ from metro_support import MetroError
 
 
 class BaseTarget:
-	mounts = {}
 	cmds = {
 		"bash": "/bin/bash",
 		"chroot": "/usr/bin/chroot",
@@ -30,6 +29,9 @@ class BaseTarget:
 		else:
 			self.env["PATH"] = "/bin:/sbin:/usr/bin:/usr/sbin"
 		self.required_files = []
+		# targets can run in parallel (see multi/jobs), so bind mounts and commands are per-target:
+		self.mounts = {}
+		self.cmds = self.cmds.copy()
 
 	def abort_if_bind_mounts(self, root_path=None):
 		if root_path is None:
@@ -53,7 +55,7 @@ class BaseTarget:
 				return
 			raise MetroError("run_script: key '%s' not found." % (key,))
 
-		if type(self.settings[key]) != list:
+		if not self.settings.is_multi(key):
 			raise MetroError("run_script: key '%s' is not a multi-line element." % (key,))
 
 		self.cr.mesg("run_script: running %s..." % key)
@@ -62,18 +64,21 @@ class BaseTarget:
 			chrootfile = "/tmp/" + key + ".metro"
 			outfile = chroot + chrootfile
 		else:
-			outfile = self.settings["path/tmp"] + "/pid/" + repr(os.getpid())
+			outfile = self.settings["path/tmp"] + "/pid/" + repr(os.getpid()) + "." + repr(threading.get_ident())
 
 		outdir = os.path.dirname(outfile)
 		if not os.path.exists(outdir):
 			os.makedirs(outdir)
 
+		# lines are expanded and written out one at a time, so large steps are never held in memory all at once:
 		with open(outfile, "w") as outfd:
-			outlines = list(self.settings[key])
-			if not chroot and "EGO_SYNC_BASE_URL" in os.environ:
-				if outlines[0] == "#!/bin/bash":
-					outlines.insert(1, f'export EGO_SYNC_BASE_URL={os.environ["EGO_SYNC_BASE_URL"]}')
-			outfd.write("\n".join(outlines) + "\n")
+			first = True
+			for line in self.settings.iter_multi(key):
+				outfd.write(line + "\n")
+				if first and not chroot and "EGO_SYNC_BASE_URL" in os.environ:
+					if line == "#!/bin/bash":
+						outfd.write(f'export EGO_SYNC_BASE_URL={os.environ["EGO_SYNC_BASE_URL"]}\n')
+				first = False
 
 		os.chmod(outfile, 0o755)
 
@@ -100,7 +105,7 @@ class BaseTarget:
 		else:
 			cmds.append(outfile)
 
-		retval = self.cr.run(cmds, env=self.env, error_scan=error_scan)
+		retval = self.cr.run(cmds, env=self.env, error_scan=error_scan, phase=key)
 		if retval != 0:
 			raise MetroError("Command failure (key %s, return value %s) : %s" % (key, repr(retval), " ".join(cmds)))
 
@@ -14,6 +14,43 @@ fi
 tarout="$[path/mirror/target]"
 # remove compression suffix:
 tarout="${tarout%.*}"
+# target/capture: inline compresses the tarball as it is captured, instead of leaving it for "buildrepo compress":
+capture=deferred
+capture=$[target/capture:zap]
+compressor=
+if [ "$capture" = "inline" ] && [ "$[target]" != "stage1" ] && [ "$[target]" != "stage2" ]; then
+	case "$[target/compression]" in
+		xz)
+			compressor="xz -9e --threads=0 -M 70%"
+			;;
+		zst)
+			compressor="zstd -q -19 -T0"
+			;;
+	esac
+fi
+if [ -n "$compressor" ]; then
+	# the tarball is written under a hidden name, and only moved into place once it is complete:
+	tmpout="$outdir/.$(basename $[path/mirror/target]).tmp"
+	tar cpf - --totals --xattrs --acls -C $[path/chroot/stage] . 2>"$tmpout.err" | $compressor > "$tmpout"
+	status=("${PIPESTATUS[@]}")
+	grep -v "^Total bytes written: " "$tmpout.err" >&2
+	# the size of the tarball before it was compressed, for metro's performance history -- a compressor reading from a
+	# pipe can't record it in the compressed file:
+	logdir="$[path/mirror/target/path]/log"
+	if [ -d "$logdir" ]; then
+		sed -n 's/^Total bytes written: \([0-9]*\).*/\1/p' "$tmpout.err" > "$logdir/$[target].tarsize"
+	fi
+	rm -f "$tmpout.err"
+	if [ ${status[0]} -ge 2 ] || [ ${status[1]} -ne 0 ]
+	then
+		echo "Error creating compressed tarball."
+		rm -f "$tmpout"
+		exit 1
+	fi
+	chown $[path/mirror/owner]:$[path/mirror/group] "$tmpout"
+	mv -f "$tmpout" "$[path/mirror/target]" || exit 1
+	exit 0
+fi
 tar cpf $tarout --xattrs --acls -C $[path/chroot/stage] .
 if [ $? -ge 2 ]
 then